@@ -1,18 +1,38 @@
-from datetime import datetime, timedelta, timezone
-from flask import Flask, jsonify, request
+from datetime import date, datetime, timedelta, timezone
+from flask import Flask, jsonify, request, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 import pika
 import threading
+import functools
 import json
 import logging
 import time
-import requests
+import os
+import zlib
+import csv
+import io
+import math
 from collections import defaultdict
-from sqlalchemy import func, and_
+from sqlalchemy import func, and_, text, inspect, event, bindparam, tuple_, select, literal_column
+from sqlalchemy.engine import Engine
+from caching import TTLCache
+from cooccurrence import CooccurrenceModel
+from recommender import compute_recommendations
+from http_client import ServiceClient
+from directory import BranchDirectory
+from event_archive import ViewArchive, DAY
+from hyperloglog import HyperLogLog
+from trending import DecayedTopK
+from playback import PlaybackSessionizer, summarize
+from messaging import DedupeStore, IdempotentConsumer, decode_events, encode_event, event_count, is_envelope, parse_timestamp
+import numpy as np
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+SERVICE_NAME = 'analytics_service'
+
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///analytics.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -20,12 +40,17 @@ db = SQLAlchemy(app)
 
 # Database models
 class CourseView(db.Model):
+    __table_args__ = (
+        db.Index('ix_course_view_course_time', 'course_id', 'timestamp'),
+        db.Index('ix_course_view_student', 'student_id'),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     course_id = db.Column(db.Integer, nullable=False)
     student_id = db.Column(db.Integer, nullable=False)
     timestamp = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
 
 class CourseRating(db.Model):
+    __table_args__ = (db.Index('ix_course_rating_course', 'course_id'),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     course_id = db.Column(db.Integer, nullable=False)
     student_id = db.Column(db.Integer, nullable=False)
@@ -39,65 +64,888 @@ class PlaylistInteraction(db.Model):
     action = db.Column(db.String(50), nullable=False)
     timestamp = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
 
+class StudentCourseHistory(db.Model):
+    # Distinct courses each student has viewed; outlives the raw views
+    __tablename__ = 'student_course_history'
+    student_id = db.Column(db.Integer, primary_key=True)
+    course_id = db.Column(db.Integer, primary_key=True)
+
+class PlaylistMembership(db.Model):
+    # Current playlist contents, mirrored from PLAYLIST_UPDATE events; the
+    # co-occurrence model is rebuilt from it at startup
+    __tablename__ = 'playlist_memberships'
+    playlist_id = db.Column(db.Integer, primary_key=True)
+    course_id = db.Column(db.Integer, primary_key=True)
+
+class StudentRecommendation(db.Model):
+    # Precomputed by the batch job; `generation` identifies the run
+    __tablename__ = 'recommendations'
+    student_id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.Integer, nullable=False, index=True)
+    course_ids = db.Column(db.Text, nullable=False)  # JSON list, best first
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+class BackfillMarker(db.Model):
+    # One row per one-time backfill that has completed
+    __tablename__ = 'backfill_markers'
+    name = db.Column(db.String(64), primary_key=True)
+    completed_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+# Local copies of user -> branch and course -> branch, kept current from
+# user_events and course_events so recommendations need no lookups elsewhere
+class UserDirectory(db.Model):
+    __tablename__ = 'user_directory'
+    user_id = db.Column(db.Integer, primary_key=True)
+    branch_id = db.Column(db.Integer, nullable=True)
+
+class CourseDirectory(db.Model):
+    __tablename__ = 'course_directory'
+    course_id = db.Column(db.Integer, primary_key=True)
+    branch_id = db.Column(db.Integer, nullable=True)
+
+class UniqueSketch(db.Model):
+    # HyperLogLog of the students who viewed, per UTC day and scope: 'all'
+    # (key 0), 'course' or 'branch' (key is the course or branch id)
+    __tablename__ = 'unique_sketches'
+    scope = db.Column(db.String(10), primary_key=True)
+    key = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    registers = db.Column(db.LargeBinary, nullable=False)
+
+# Rollups, updated incrementally by the consumer as events arrive so the
+# per-course endpoints never scan raw events
+RATING_BUCKETS = range(1, 6)
+
+class CourseStats(db.Model):
+    __tablename__ = 'course_stats'
+    course_id = db.Column(db.Integer, primary_key=True)
+    views = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_1 = db.Column(db.Integer, nullable=False, default=0)
+    rating_2 = db.Column(db.Integer, nullable=False, default=0)
+    rating_3 = db.Column(db.Integer, nullable=False, default=0)
+    rating_4 = db.Column(db.Integer, nullable=False, default=0)
+    rating_5 = db.Column(db.Integer, nullable=False, default=0)
+
+class CourseDailyStats(db.Model):
+    __tablename__ = 'course_daily_stats'
+    course_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    views = db.Column(db.Integer, nullable=False, default=0)
+    unique_viewers = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+
+class PlaylistDailyStats(db.Model):
+    # Playlist interactions folded out of the raw table by the retention job
+    __tablename__ = 'playlist_daily_stats'
+    playlist_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    action = db.Column(db.String(50), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class CoursePlaybackStats(db.Model):
+    # Finished playback sessions per course. `watched` counts the sessions
+    # that played each second of the video and `drop_off` the sessions that
+    # stopped at it; both are zlib-compressed int32 arrays
+    __tablename__ = 'course_playback_stats'
+    course_id = db.Column(db.Integer, primary_key=True)
+    sessions = db.Column(db.Integer, nullable=False, default=0)
+    watch_seconds = db.Column(db.Integer, nullable=False, default=0)
+    completion_sessions = db.Column(db.Integer, nullable=False, default=0)  # duration was known
+    completion_sum = db.Column(db.Float, nullable=False, default=0)
+    completed = db.Column(db.Integer, nullable=False, default=0)
+    duration = db.Column(db.Integer, nullable=True)
+    watched = db.Column(db.LargeBinary, nullable=False)
+    drop_off = db.Column(db.LargeBinary, nullable=False)
+
+class CourseDailyViewer(db.Model):
+    # Membership set behind course_daily_stats.unique_viewers
+    __tablename__ = 'course_daily_viewers'
+    course_id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    student_id = db.Column(db.Integer, primary_key=True)
+
+def utc_day(timestamp):
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc)
+    return timestamp.date()
+
+def epoch_seconds(timestamp):
+    # Naive timestamps are UTC, as everywhere else in this service
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp())
+
+def epoch_day_start(days_ago=0):
+    return (int(time.time()) // DAY - days_ago) * DAY
+
+def upsert_increments(model, key_columns, rows):
+    """Bulk INSERT rows, adding their values onto rows whose key already exists.
+
+    Every row must carry the same columns.
+    """
+    if not rows:
+        return
+    stmt = sqlite_insert(model)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={column: getattr(model, column) + stmt.excluded[column]
+              for column in rows[0] if column not in key_columns}
+    )
+    db.session.execute(stmt, rows)
+
+def apply_view_rollups(views):
+    """Fold a batch of view rows into the rollups with a few executemany calls."""
+    per_course = defaultdict(int)
+    per_day = defaultdict(int)
+    viewers = set()
+    for view in views:
+        day = utc_day(view['timestamp'])
+        per_course[view['course_id']] += 1
+        per_day[(view['course_id'], day)] += 1
+        viewers.add((view['course_id'], day, view['student_id']))
+
+    upsert_increments(CourseStats, ['course_id'], [
+        {"course_id": course_id, "views": count} for course_id, count in per_course.items()
+    ])
+    upsert_increments(CourseDailyStats, ['course_id', 'day'], [
+        {"course_id": course_id, "day": day, "views": count} for (course_id, day), count in per_day.items()
+    ])
+    db.session.execute(sqlite_insert(CourseDailyViewer).on_conflict_do_nothing(), [
+        {"course_id": course_id, "day": day, "student_id": student_id}
+        for course_id, day, student_id in viewers
+    ])
+    db.session.execute(sqlite_insert(StudentCourseHistory).on_conflict_do_nothing(), [
+        {"student_id": student_id, "course_id": course_id}
+        for course_id, student_id in {(c, s) for c, _, s in viewers}
+    ])
+    # Recount uniques for the touched days from the (indexed) viewer set.
+    # Viewer sets of days past retention are purged, so a late event for
+    # such a day must not lower the count
+    db.session.execute(text(
+        "UPDATE course_daily_stats SET unique_viewers = MAX(unique_viewers, "
+        "(SELECT COUNT(*) FROM course_daily_viewers "
+        " WHERE course_id = :course_id AND day = :day)) "
+        "WHERE course_id = :course_id AND day = :day"
+    ), [{"course_id": course_id, "day": day} for course_id, day in per_day])
+
+def apply_rating_rollups(ratings):
+    per_course = {}
+    per_day = {}
+    for rating in ratings:
+        course = per_course.setdefault(rating['course_id'], {
+            "course_id": rating['course_id'], "rating_sum": 0, "rating_count": 0,
+            **{f"rating_{bucket}": 0 for bucket in RATING_BUCKETS}
+        })
+        course['rating_sum'] += rating['rating']
+        course['rating_count'] += 1
+        if rating['rating'] in RATING_BUCKETS:
+            course[f"rating_{rating['rating']}"] += 1
+
+        key = (rating['course_id'], utc_day(rating['timestamp']))
+        daily = per_day.setdefault(key, {
+            "course_id": key[0], "day": key[1], "rating_sum": 0, "rating_count": 0
+        })
+        daily['rating_sum'] += rating['rating']
+        daily['rating_count'] += 1
+
+    upsert_increments(CourseStats, ['course_id'], list(per_course.values()))
+    upsert_increments(CourseDailyStats, ['course_id', 'day'], list(per_day.values()))
+
+def rebuild_rollups():
+    """Recompute every rollup from the raw event tables."""
+    for model in (CourseStats, CourseDailyStats, CourseDailyViewer):
+        db.session.query(model).delete()
+    db.session.execute(text(
+        "INSERT INTO course_daily_viewers (course_id, day, student_id) "
+        "SELECT DISTINCT course_id, date(timestamp), student_id FROM course_view"
+    ))
+    db.session.execute(text(
+        "INSERT INTO course_daily_stats (course_id, day, views, unique_viewers, rating_sum, rating_count) "
+        "SELECT course_id, day, SUM(views), SUM(uniques), SUM(rating_sum), SUM(rating_count) FROM ("
+        " SELECT course_id, date(timestamp) AS day, COUNT(*) AS views, COUNT(DISTINCT student_id) AS uniques,"
+        "  0 AS rating_sum, 0 AS rating_count FROM course_view GROUP BY course_id, date(timestamp)"
+        " UNION ALL"
+        " SELECT course_id, date(timestamp), 0, 0, SUM(rating), COUNT(*)"
+        "  FROM course_rating GROUP BY course_id, date(timestamp)"
+        ") GROUP BY course_id, day"
+    ))
+    db.session.execute(text(
+        "INSERT INTO course_stats (course_id, views, rating_sum, rating_count, "
+        " rating_1, rating_2, rating_3, rating_4, rating_5) "
+        "SELECT course_id, SUM(views), SUM(rating_sum), SUM(rating_count), "
+        " SUM(r1), SUM(r2), SUM(r3), SUM(r4), SUM(r5) FROM ("
+        " SELECT course_id, COUNT(*) AS views, 0 AS rating_sum, 0 AS rating_count,"
+        "  0 AS r1, 0 AS r2, 0 AS r3, 0 AS r4, 0 AS r5 FROM course_view GROUP BY course_id"
+        " UNION ALL"
+        " SELECT course_id, 0, SUM(rating), COUNT(*),"
+        "  SUM(rating = 1), SUM(rating = 2), SUM(rating = 3), SUM(rating = 4), SUM(rating = 5)"
+        "  FROM course_rating GROUP BY course_id"
+        ") GROUP BY course_id"
+    ))
+    db.session.commit()
+
+@event.listens_for(Engine, 'connect')
+def configure_sqlite(dbapi_connection, connection_record):
+    # WAL lets the endpoints read while the consumer writes batches
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+def enable_incremental_vacuum():
+    """Switch the database to incremental auto_vacuum, once.
+
+    The switch takes a full VACUUM (instant on a new, empty database),
+    which locks the whole database, so it runs at startup before the
+    consumers start and never from the retention job.
+    """
+    with db.engine.connect() as conn:
+        raw = conn.connection.driver_connection
+        if raw.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return
+        logger.info("Converting the database to incremental auto_vacuum (one-time full VACUUM)")
+        raw.executescript("PRAGMA auto_vacuum=INCREMENTAL; VACUUM;")
+
 with app.app_context():
+    enable_incremental_vacuum()
+    rollups_existed = inspect(db.engine).has_table('course_stats')
+    sketches_existed = inspect(db.engine).has_table('unique_sketches')
+    history_existed = inspect(db.engine).has_table('student_course_history')
     db.create_all()
+    for model in (CourseView, CourseRating):
+        for index in model.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+    if not rollups_existed:
+        # Seed the rollups from events recorded before they existed
+        rebuild_rollups()
+    if not history_existed:
+        db.session.execute(text(
+            "INSERT OR IGNORE INTO student_course_history (student_id, course_id) "
+            "SELECT DISTINCT student_id, course_id FROM course_view"
+        ))
+        db.session.commit()
+
+# Columnar copy of every course view for scans over long time ranges
+VIEW_ARCHIVE_DIR = os.path.join(app.instance_path, 'view_archive')
+view_archive = ViewArchive(VIEW_ARCHIVE_DIR)
+
+def archive_views(views):
+    view_archive.append(
+        [v['course_id'] for v in views],
+        [v['student_id'] for v in views],
+        [epoch_seconds(v['timestamp']) for v in views]
+    )
+
+def backfill_view_archive(chunk_size=100000):
+    # One pass over the views recorded before the archive existed
+    query = db.session.query(CourseView.course_id, CourseView.student_id, CourseView.timestamp).order_by(CourseView.id)
+    chunk = []
+    for course_id, student_id, timestamp in query.yield_per(chunk_size):
+        chunk.append({"course_id": course_id, "student_id": student_id, "timestamp": timestamp})
+        if len(chunk) == chunk_size:
+            archive_views(chunk)
+            chunk = []
+    if chunk:
+        archive_views(chunk)
+
+with app.app_context():
+    if not len(view_archive):
+        backfill_view_archive()
+
+# "Frequently paired" model over playlist contents
+cooccurrence = CooccurrenceModel()
+with app.app_context():
+    cooccurrence.load(db.session.query(PlaylistMembership.playlist_id, PlaylistMembership.course_id))
+
+# In-memory branch directories, loaded from their tables
+user_branches = BranchDirectory()
+course_branches = BranchDirectory()
+with app.app_context():
+    user_branches.load(db.session.query(UserDirectory.user_id, UserDirectory.branch_id))
+    course_branches.load(db.session.query(CourseDirectory.course_id, CourseDirectory.branch_id))
+
+# Approximate distinct viewers, maintained on ingest
+SKETCH_SCOPES = ('all', 'course', 'branch')
+SKETCH_BACKFILL_DAYS = 90
+SKETCH_LOAD_CHUNK = 300
+UNIQUES_MAX_DAYS = 365
+EXACT_UNIQUES_MAX_DAYS = 90  # exact counts scan every view in the range
+EPOCH = date(1970, 1, 1)
+
+def sketch_groups(course_ids, student_ids, epoch_days):
+    """{(scope, key, day): student ids} for a batch of views."""
+    course = np.asarray(course_ids, dtype=np.int64)
+    student = np.asarray(student_ids, dtype=np.int64)
+    days = np.asarray(epoch_days, dtype=np.int64)
+    branch = course_branches.lookup(course)
+    known = branch != BranchDirectory.UNKNOWN
+
+    scope = np.concatenate([np.zeros(len(course)), np.ones(len(course)), np.full(known.sum(), 2)]).astype(np.int64)
+    key = np.concatenate([np.zeros(len(course), dtype=np.int64), course, branch[known]])
+    day = np.concatenate([days, days, days[known]])
+    who = np.concatenate([student, student, student[known]])
+
+    order = np.lexsort((key, day, scope))
+    scope, key, day, who = scope[order], key[order], day[order], who[order]
+    starts = np.flatnonzero(np.r_[True, (scope[1:] != scope[:-1]) | (key[1:] != key[:-1]) | (day[1:] != day[:-1])])
+    ends = np.r_[starts[1:], len(who)]
+    return {
+        (SKETCH_SCOPES[scope[i]], int(key[i]), EPOCH + timedelta(days=int(day[i]))): who[i:j]
+        for i, j in zip(starts.tolist(), ends.tolist())
+    }
+
+def load_sketches(keys):
+    sketches = {}
+    for start in range(0, len(keys), SKETCH_LOAD_CHUNK):
+        chunk = keys[start:start + SKETCH_LOAD_CHUNK]
+        for row in UniqueSketch.query.filter(tuple_(UniqueSketch.scope, UniqueSketch.key, UniqueSketch.day).in_(chunk)):
+            sketches[(row.scope, row.key, row.day)] = HyperLogLog.from_bytes(row.registers)
+    return sketches
+
+def update_unique_sketches(groups):
+    # Adding ids is idempotent, so replaying a batch cannot inflate counts
+    if not groups:
+        return
+    sketches = load_sketches(list(groups))
+    rows = []
+    for (scope, key, day), students in groups.items():
+        sketch = sketches.get((scope, key, day)) or HyperLogLog()
+        sketch.add_many(students)
+        rows.append({"scope": scope, "key": key, "day": day, "registers": sketch.to_bytes()})
+    stmt = sqlite_insert(UniqueSketch)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['scope', 'key', 'day'],
+        set_={"registers": stmt.excluded.registers}
+    ), rows)
+
+def backfill_unique_sketches():
+    since = epoch_day_start(days_ago=SKETCH_BACKFILL_DAYS - 1)
+    for course, student, ts, _ in view_archive.scan(since, epoch_day_start(days_ago=-1)):
+        update_unique_sketches(sketch_groups(course, student, ts // DAY))
+        db.session.commit()
+
+def sketch_uniques(scope, key, days):
+    """([(day, estimated uniques)], estimated uniques over all `days` days)."""
+    first_day = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+    sketches = {
+        row.day: HyperLogLog.from_bytes(row.registers)
+        for row in UniqueSketch.query.filter(
+            UniqueSketch.scope == scope, UniqueSketch.key == key, UniqueSketch.day >= first_day
+        )
+    }
+    daily = [(day, sketches[day].count()) for day in sorted(sketches)]
+    return daily, HyperLogLog.union(sketches.values()).count()
+
+def exact_uniques(scope, key, days):
+    """Same as sketch_uniques, counted exactly from the view archive."""
+    since = epoch_day_start(days_ago=days - 1)
+    course_id = {'all': None, 'course': key, 'branch': course_branches.ids_in_branch(key)}[scope]
+    if scope == 'branch' and not course_id:
+        return [], 0
+    counts = view_archive.daily_active_users(since, since + days * DAY, course_id)
+    daily = [(EPOCH + timedelta(days=since // DAY + i), int(count)) for i, count in enumerate(counts) if count]
+    return daily, view_archive.unique_students(since, since + days * DAY, course_id)
+
+with app.app_context():
+    if not sketches_existed:
+        backfill_unique_sketches()
+
+# Trending courses: decayed view counts per window, overall and per branch,
+# kept in memory and replayed from the view archive at startup
+TRENDING_WINDOWS = {'1h': 3600, '24h': DAY, '7d': 7 * DAY}
+TRENDING_TOP_K = 50
+TRENDING_REPLAY_LIFETIMES = 4  # older views weigh under 2%
+trending = {name: DecayedTopK(seconds, k=TRENDING_TOP_K) for name, seconds in TRENDING_WINDOWS.items()}
+
+def record_trending(course_ids, timestamps):
+    course = np.asarray(course_ids, dtype=np.int64)
+    ts = np.asarray(timestamps, dtype=np.int64)
+    branch = course_branches.lookup(course)
+    known = branch != BranchDirectory.UNKNOWN
+    for window in trending.values():
+        window.add_many(course, ts)
+        window.add_many(course[known], ts[known], branch[known])
+
+def replay_trending():
+    now = int(time.time())
+    since = now - TRENDING_REPLAY_LIFETIMES * max(TRENDING_WINDOWS.values())
+    for course, _, ts, _ in view_archive.scan(since, now + 1):
+        record_trending(course, ts)
+
+replay_trending()
+
+# Playback sessions built from streaming_service heartbeats. Open sessions
+# live in memory; finished ones are folded into course_playback_stats
+PLAYBACK_SESSION_GAP = 600  # seconds without a heartbeat that end a session
+PLAYBACK_SWEEP_INTERVAL = 60
+COMPLETION_THRESHOLD = 0.9
+PLAYBACK_MAX_BUCKET = 600
+playback_sessions = PlaybackSessionizer(gap=PLAYBACK_SESSION_GAP)
+
+def pack_counts(counts):
+    return zlib.compress(counts.astype('<i4').tobytes())
+
+def unpack_counts(data):
+    return np.frombuffer(zlib.decompress(data), dtype='<i4').astype(np.int64)
+
+def add_counts(total, counts):
+    if len(counts) > len(total):
+        total = np.pad(total, (0, len(counts) - len(total)))
+    total[:len(counts)] += counts
+    return total
+
+def apply_playback_sessions(sessions):
+    by_course = defaultdict(list)
+    for session in sessions:
+        by_course[session.course_id].append(session)
+    existing = {row.course_id: row for row in CoursePlaybackStats.query.filter(
+        CoursePlaybackStats.course_id.in_(list(by_course))
+    )}
+    for course_id, finished in by_course.items():
+        row = existing.get(course_id) or CoursePlaybackStats(
+            course_id=course_id, sessions=0, watch_seconds=0, completion_sessions=0,
+            completion_sum=0, completed=0, watched=pack_counts(np.zeros(0)), drop_off=pack_counts(np.zeros(0))
+        )
+        durations = [s.duration for s in finished if s.duration] + ([row.duration] if row.duration else [])
+        row.duration = max(durations) if durations else None
+        watched, drop_off = unpack_counts(row.watched), unpack_counts(row.drop_off)
+        for session in finished:
+            if not session.duration:
+                session.duration = row.duration
+            seconds, completion, stopped_at = summarize(session)
+            row.sessions += 1
+            row.watch_seconds += seconds
+            if completion is not None:
+                row.completion_sessions += 1
+                row.completion_sum += completion
+                row.completed += completion >= COMPLETION_THRESHOLD
+            watched = add_counts(watched, session.watched.astype(np.int64))
+            stops = np.zeros(stopped_at + 1, dtype=np.int64)
+            stops[stopped_at] = 1
+            drop_off = add_counts(drop_off, stops)
+        row.watched, row.drop_off = pack_counts(watched), pack_counts(drop_off)
+        db.session.add(row)
+
+def store_playback_sessions(sessions):
+    if not sessions:
+        return
+    try:
+        apply_playback_sessions(sessions)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Storing {len(sessions)} playback sessions failed: {e}")
+
+def sweep_playback_sessions():
+    while True:
+        time.sleep(PLAYBACK_SWEEP_INTERVAL)
+        with app.app_context():
+            store_playback_sessions(playback_sessions.expire(time.time()))
+
+# Outbound calls to the other services share one pooled client
+http = ServiceClient({
+    "user": "http://user_service:3001",
+    "course": "http://course_service:3002",
+    "playlist": "http://playlist_service:3004"
+})
 
 # In-memory cache for frequent queries
-cache = {}
 CACHE_EXPIRATION = 300  # 5 minutes
+CACHE_MAX_ENTRIES = 4096
+VIEW_CACHE_EXPIRATION = 60  # view-driven results go stale faster
+cache = TTLCache(max_size=CACHE_MAX_ENTRIES, default_ttl=CACHE_EXPIRATION)
+
+# RabbitMQ consumer: batched ingestion
+# Event ids already applied, shared by the interaction and directory consumers
+with app.app_context():
+    consumer = IdempotentConsumer(SERVICE_NAME, DedupeStore(db.engine))
+
+INTERACTIONS_QUEUE = 'user_interactions'
+INTERACTIONS_DLQ = 'user_interactions.dlq'
+INGEST_BATCH_SIZE = 1000
+INGEST_FLUSH_INTERVAL = 0.2  # seconds
+INGEST_PREFETCH = INGEST_BATCH_SIZE * 2
+
+def finite_float(value):
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError(f"non-finite number {value!r}")
+    return number
+
+def parse_interaction(event):
+    """Turn one decoded event into (event type, row to insert).
+
+    Returns None for event types this service does not store and raises
+    ValueError for events that can never be processed.
+    """
+    try:
+        kind = event['event']
+        if kind == 'COURSE_VIEWED':
+            return kind, {
+                "course_id": int(event['course_id']),
+                "student_id": int(event['student_id']),
+                "timestamp": parse_timestamp(event['timestamp'])
+            }
+        if kind == 'COURSE_RATED':
+            return kind, {
+                "course_id": int(event['course_id']),
+                "student_id": int(event['student_id']),
+                "rating": int(event['rating']),
+                "timestamp": parse_timestamp(event['timestamp'])
+            }
+        if kind == 'PLAYLIST_INTERACTION':
+            return kind, {
+                "playlist_id": int(event['playlist_id']),
+                "student_id": int(event['student_id']),
+                "action": str(event['action']),
+                "timestamp": parse_timestamp(event['timestamp'])
+            }
+        if kind == 'PLAYBACK_HEARTBEAT':
+            return kind, {
+                "course_id": int(event['course_id']),
+                "student_id": int(event['student_id']),
+                "position": finite_float(event['position']),
+                "duration": finite_float(event['duration']) if event.get('duration') else None,
+                "state": str(event.get('state', 'playing')),
+                "ts": epoch_seconds(parse_timestamp(event['timestamp']))
+            }
+        if kind == 'PLAYLIST_UPDATE':
+            # Single add/remove, or a batch from PATCH /playlists/<id>/courses
+            if event['action'] == 'batch':
+                changes = [(int(c), 'add') for c in event.get('added', [])]
+                changes += [(int(c), 'remove') for c in event.get('removed', [])]
+            elif event['action'] in ('add', 'remove'):
+                changes = [(int(event['course_id']), event['action'])]
+            else:
+                raise ValueError(f"unknown action {event['action']}")
+            return kind, {"playlist_id": int(event['playlist_id']), "changes": changes}
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f"Malformed interaction event: {e}")
+    return None
+
+def group_interactions(events):
+    """Parsed events by type, and the net action per (playlist, course)."""
+    grouped = defaultdict(list)
+    for kind, row in events:
+        grouped[kind].append(row)
+
+    # Last action per (playlist, course) wins within a batch
+    membership = {}
+    for update in grouped['PLAYLIST_UPDATE']:
+        for course_id, action in update['changes']:
+            membership.pop((update['playlist_id'], course_id), None)
+            membership[(update['playlist_id'], course_id)] = action
+    return grouped, membership
+
+def ingest_interactions(events, processed=()):
+    """Write parsed events grouped by type in one transaction.
+
+    The ids of the decoded `processed` events are recorded in the same
+    transaction, so a redelivery after a crash is never counted twice.
+    Only the database is written here, so a failed call leaves nothing
+    behind and may be retried; `after_ingest` takes over once committed.
+    """
+    grouped, membership = group_interactions(events)
+
+    if grouped['COURSE_VIEWED']:
+        db.session.execute(CourseView.__table__.insert(), grouped['COURSE_VIEWED'])
+        apply_view_rollups(grouped['COURSE_VIEWED'])
+        update_unique_sketches(sketch_groups(
+            [v['course_id'] for v in grouped['COURSE_VIEWED']],
+            [v['student_id'] for v in grouped['COURSE_VIEWED']],
+            [epoch_seconds(v['timestamp']) // DAY for v in grouped['COURSE_VIEWED']]
+        ))
+    if grouped['COURSE_RATED']:
+        db.session.execute(CourseRating.__table__.insert(), grouped['COURSE_RATED'])
+        apply_rating_rollups(grouped['COURSE_RATED'])
+    if grouped['PLAYLIST_INTERACTION']:
+        db.session.execute(PlaylistInteraction.__table__.insert(), grouped['PLAYLIST_INTERACTION'])
+
+    added = [{"playlist_id": p, "course_id": c} for (p, c), action in membership.items() if action == 'add']
+    removed = [{"playlist_id": p, "course_id": c} for (p, c), action in membership.items() if action == 'remove']
+    if added:
+        db.session.execute(sqlite_insert(PlaylistMembership).on_conflict_do_nothing(), added)
+    if removed:
+        db.session.execute(PlaylistMembership.__table__.delete().where(and_(
+            PlaylistMembership.playlist_id == bindparam('playlist_id'),
+            PlaylistMembership.course_id == bindparam('course_id')
+        )), removed)
+    consumer.processed(processed, db.session)
+    db.session.commit()
+
+def after_ingest(events):
+    """Feed committed events to the archive and the in-memory models.
+
+    The rows are already stored, so failures are logged, never raised:
+    nothing here may send the events through ingestion again.
+    """
+    grouped, membership = group_interactions(events)
+    if grouped['COURSE_VIEWED']:
+        try:
+            archive_views(grouped['COURSE_VIEWED'])
+        except Exception as e:
+            logger.error(f"Archiving {len(grouped['COURSE_VIEWED'])} views failed: {e}")
+        try:
+            record_trending(
+                [v['course_id'] for v in grouped['COURSE_VIEWED']],
+                [epoch_seconds(v['timestamp']) for v in grouped['COURSE_VIEWED']]
+            )
+        except Exception as e:
+            logger.error(f"Recording {len(grouped['COURSE_VIEWED'])} trending views failed: {e}")
+    if grouped['PLAYBACK_HEARTBEAT']:
+        # Heartbeats are not stored raw; they only feed the sessionizer
+        try:
+            store_playback_sessions(playback_sessions.add(grouped['PLAYBACK_HEARTBEAT']))
+        except Exception as e:
+            logger.error(f"Sessionizing {len(grouped['PLAYBACK_HEARTBEAT'])} heartbeats failed: {e}")
+    if grouped['COURSE_RATED']:
+        cache.invalidate('top_rated')
+    try:
+        for (playlist_id, course_id), action in membership.items():
+            if action == 'add':
+                cooccurrence.add(playlist_id, course_id)
+            else:
+                cooccurrence.remove(playlist_id, course_id)
+    except Exception as e:
+        logger.error(f"Updating co-occurrence for {len(membership)} memberships failed: {e}")
+
+def process_interaction_batch(channel, messages):
+    """Ingest (delivery_tag, properties, body) triples and ack them all at once.
+
+    A message is one JSON event or an envelope of many. Undecodable messages
+    and unparseable events go straight to the dead-letter queue, events from
+    an envelope as JSON of their own. Redelivered events are skipped before
+    parsing. If the batch transaction fails, events are retried one by one
+    so a single bad event is dead-lettered instead of blocking the rest.
+    """
+    decoded, poison = [], []
+    for _, properties, body in messages:
+        try:
+            events = decode_events(body, properties)
+        except ValueError as e:
+            logger.error(f"Undecodable interaction message: {e}")
+            poison.append(body)
+            continue
+        enveloped = is_envelope(properties)
+        decoded += [(encode_event(payload) if enveloped else body, payload) for payload in events]
+
+    parsed = []
+    for raw, payload in consumer.fresh(decoded, key=lambda item: item[1]):
+        try:
+            interaction = parse_interaction(payload)
+        except ValueError as e:
+            logger.error(str(e))
+            poison.append(raw)
+            continue
+        if interaction:
+            parsed.append((raw, payload, interaction))
+
+    with app.app_context():
+        # Only the transaction is retried; what it committed is handed to
+        # after_ingest once, outside the retry
+        try:
+            ingest_interactions([interaction for _, _, interaction in parsed], [payload for _, payload, _ in parsed])
+            committed = [interaction for _, _, interaction in parsed]
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Batch ingestion failed, retrying individually: {e}")
+            committed = []
+            for raw, payload, interaction in parsed:
+                try:
+                    ingest_interactions([interaction], [payload])
+                    committed.append(interaction)
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Event processing failed: {e}")
+                    poison.append(raw)
+        after_ingest(committed)
+
+    for body in poison:
+        channel.basic_publish(
+            exchange='',
+            routing_key=INTERACTIONS_DLQ,
+            body=body,
+            properties=pika.BasicProperties(delivery_mode=2)
+        )
+    channel.basic_ack(delivery_tag=messages[-1][0], multiple=True)
+    logger.info(f"Ingested {len(committed)} events ({len(poison)} dead-lettered)")
+
+MEMBERSHIP_BACKFILL = 'playlist_memberships'
+MEMBERSHIP_BACKFILL_ATTEMPTS = 5
+MEMBERSHIP_BACKFILL_RETRY = 10  # seconds
+
+def fetch_playlist_memberships():
+    """Every (playlist_id, course_id) pair, paged from playlist_service."""
+    pairs = []
+    cursor = 0
+    while cursor is not None:
+        response = http.get("playlist", "/playlists/memberships", params={"cursor": cursor}, timeout=30)
+        response.raise_for_status()
+        for playlist in response.json()['playlists']:
+            pairs += [(playlist['id'], course_id) for course_id in playlist['course_ids']]
+        cursor = response.headers.get('X-Next-Cursor')
+    return pairs
+
+def backfill_playlist_memberships():
+    """Seed playlist_memberships from playlist_service, once.
+
+    PLAYLIST_UPDATE events only describe changes, so playlists that existed
+    before analytics mirrored them never reached the table or the
+    co-occurrence model. This copies the current contents instead. It runs
+    on the interaction consumer's thread before consuming starts, so every
+    queued PLAYLIST_UPDATE is applied after the copy, on top of it. If
+    playlist_service stays unreachable, the next start tries again.
+    """
+    with app.app_context():
+        if db.session.get(BackfillMarker, MEMBERSHIP_BACKFILL):
+            return
+    for attempt in range(1, MEMBERSHIP_BACKFILL_ATTEMPTS + 1):
+        try:
+            pairs = fetch_playlist_memberships()
+            break
+        except Exception as e:
+            logger.warning(f"Playlist membership backfill attempt {attempt} failed: {e}")
+            time.sleep(MEMBERSHIP_BACKFILL_RETRY)
+    else:
+        logger.error("Playlist membership backfill skipped; it is retried at the next start")
+        return
+
+    with app.app_context():
+        db.session.execute(PlaylistMembership.__table__.delete())
+        if pairs:
+            db.session.execute(PlaylistMembership.__table__.insert(), [
+                {"playlist_id": playlist_id, "course_id": course_id} for playlist_id, course_id in pairs
+            ])
+        db.session.add(BackfillMarker(name=MEMBERSHIP_BACKFILL))
+        db.session.commit()
+    cooccurrence.load(pairs)
+    logger.info(f"Backfilled {len(pairs)} playlist memberships")
 
-# RabbitMQ Consumer with enhanced error handling
 def consume_user_interactions():
+    backfill_playlist_memberships()
     while True:
         try:
             connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
             channel = connection.channel()
-            channel.queue_declare(queue='user_interactions', durable=True)
+            channel.queue_declare(queue=INTERACTIONS_QUEUE, durable=True)
+            channel.queue_declare(queue=INTERACTIONS_DLQ, durable=True)
+            channel.basic_qos(prefetch_count=INGEST_PREFETCH)
 
-            def callback(ch, method, properties, body):
+            # Batches are sized in events; an envelope carries many
+            messages = []
+            pending = 0
+            deadline = None
+            for method, properties, body in channel.consume(
+                INTERACTIONS_QUEUE, inactivity_timeout=INGEST_FLUSH_INTERVAL
+            ):
+                if method is not None:
+                    messages.append((method.delivery_tag, properties, body))
+                    pending += event_count(properties)
+                    if deadline is None:
+                        deadline = time.monotonic() + INGEST_FLUSH_INTERVAL
+                    if pending < INGEST_BATCH_SIZE and time.monotonic() < deadline:
+                        continue
+                if messages:
+                    process_interaction_batch(channel, messages)
+                    messages = []
+                    pending = 0
+                    deadline = None
+            
+        except Exception as e:
+            logger.error(f"Connection error: {e}")
+            time.sleep(5)
+
+# Directory consumer: each stream is a fanout exchange and analytics binds its
+# own queue, so it sees every event without taking any from other services
+DIRECTORY_QUEUES = {
+    'user_events': 'analytics.user_events',
+    'course_events': 'analytics.course_events'
+}
+
+def record_branches(model, key, directory, branches):
+    """Upsert {id: branch_id} into a directory table and its in-memory map."""
+    if not branches:
+        return
+    stmt = sqlite_insert(model)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=[key],
+        set_={"branch_id": stmt.excluded.branch_id}
+    ), [{key: entity_id, "branch_id": branch_id} for entity_id, branch_id in branches.items()])
+    db.session.commit()
+    for entity_id, branch_id in branches.items():
+        directory.set(entity_id, branch_id)
+
+def forget_branch(model, key, directory, entity_id):
+    db.session.query(model).filter(getattr(model, key) == entity_id).delete()
+    db.session.commit()
+    directory.remove(entity_id)
+
+def apply_directory_event(event):
+    kind = event.get('event')
+    if kind in ('USER_CREATED', 'USER_UPDATED'):
+        record_branches(UserDirectory, 'user_id', user_branches, {event['user_id']: event.get('branch_id')})
+    elif kind == 'USER_DELETED':
+        forget_branch(UserDirectory, 'user_id', user_branches, event['user_id'])
+        # The precomputed row would otherwise outlive the student
+        StudentRecommendation.query.filter_by(student_id=event['user_id']).delete()
+        db.session.commit()
+    elif kind in ('COURSE_CREATED', 'COURSE_UPDATED'):
+        course_id = event['course_id']
+        previous = course_branches.get(course_id)
+        record_branches(CourseDirectory, 'course_id', course_branches, {course_id: event.get('branch_id')})
+        if previous is not None and previous != event.get('branch_id'):
+            cache.invalidate('branch_popular')
+    elif kind == 'COURSE_DELETED':
+        course_id = event['course_id']
+        forget_branch(CourseDirectory, 'course_id', course_branches, course_id)
+        PlaylistMembership.query.filter_by(course_id=course_id).delete()
+        db.session.commit()
+        cooccurrence.remove_course(course_id)
+        for window in trending.values():
+            window.remove(course_id)
+        cache.invalidate('branch_popular')
+
+def consume_directory_events():
+    while True:
+        try:
+            connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
+            channel = connection.channel()
+
+            def callback(ch, method, properties, body, queue):
+                # Acked only once applied. A failure is requeued once, in case
+                # it was transient, and dead-lettered when it fails again.
                 try:
                     with app.app_context():
-                        event = json.loads(body)
-                        logger.info(f"Processing event: {event['event']}")
-                        
-                        if event['event'] == 'COURSE_VIEWED':
-                            course_view = CourseView(
-                                course_id=event['course_id'],
-                                student_id=event['student_id'],
-                                timestamp=datetime.fromisoformat(event['timestamp'])
-                            )
-                            db.session.add(course_view)
-                            
-                        elif event['event'] == 'COURSE_RATED':
-                            course_rating = CourseRating(
-                                course_id=event['course_id'],
-                                student_id=event['student_id'],
-                                rating=event['rating'],
-                                timestamp=datetime.fromisoformat(event['timestamp'])
-                            )
-                            db.session.add(course_rating)
-                            
-                        elif event['event'] == 'PLAYLIST_INTERACTION':
-                            interaction = PlaylistInteraction(
-                                playlist_id=event['playlist_id'],
-                                student_id=event['student_id'],
-                                action=event['action'],
-                                timestamp=datetime.fromisoformat(event['timestamp'])
-                            )
-                            db.session.add(interaction)
-                            
-                        db.session.commit()
-                        ch.basic_ack(delivery_tag=method.delivery_tag)
-                        
+                        try:
+                            consumer.handle(body, properties, apply_directory_event)
+                        except Exception:
+                            db.session.rollback()
+                            raise
                 except Exception as e:
-                    logger.error(f"Event processing failed: {e}")
-                    db.session.rollback()
+                    logger.error(f"Directory event processing error: {e}")
+                    if method.redelivered:
+                        ch.basic_publish(
+                            exchange='',
+                            routing_key=queue + '.dlq',
+                            body=body,
+                            properties=properties
+                        )
+                        ch.basic_ack(delivery_tag=method.delivery_tag)
+                    else:
+                        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                    return
+                ch.basic_ack(delivery_tag=method.delivery_tag)
 
-            channel.basic_consume(queue='user_interactions', 
-                                on_message_callback=callback,
-                                auto_ack=False)
+            for exchange, queue in DIRECTORY_QUEUES.items():
+                channel.exchange_declare(exchange=exchange, exchange_type='fanout', durable=True)
+                channel.queue_declare(queue=queue, durable=True)
+                channel.queue_declare(queue=queue + '.dlq', durable=True)
+                channel.queue_bind(queue=queue, exchange=exchange)
+                channel.basic_consume(queue=queue, on_message_callback=functools.partial(callback, queue=queue))
             channel.start_consuming()
-            
         except Exception as e:
             logger.error(f"Connection error: {e}")
             time.sleep(5)
@@ -105,55 +953,100 @@ def consume_user_interactions():
 # Enhanced Analytics Endpoints
 @app.route('/analytics/course/<int:course_id>', methods=['GET'])
 def get_course_analytics(course_id):
-    # Basic stats
-    views_count = CourseView.query.filter_by(course_id=course_id).count()
-    ratings = CourseRating.query.filter_by(course_id=course_id).all()
+    # Totals and distribution come from one rollup row
+    stats = db.session.get(CourseStats, course_id) or CourseStats(
+        course_id=course_id, views=0, rating_sum=0, rating_count=0,
+        **{f"rating_{bucket}": 0 for bucket in RATING_BUCKETS}
+    )
     
-    # Rating distribution
-    rating_dist = db.session.query(
-        CourseRating.rating,
-        func.count(CourseRating.id)
-    ).filter_by(course_id=course_id).group_by(CourseRating.rating).all()
-    
-    # View trends (last 30 days)
-    thirty_days_ago = datetime.now(timezone.utc) - timedelta(days=30)
-    view_trend = db.session.query(
-        func.date(CourseView.timestamp),
-        func.count(CourseView.id)
-    ).filter(and_(
-        CourseView.course_id == course_id,
-        CourseView.timestamp >= thirty_days_ago
-    )).group_by(func.date(CourseView.timestamp)).all()
+    # View trends (last 30 days), one row per day
+    thirty_days_ago = (datetime.now(timezone.utc) - timedelta(days=30)).date()
+    view_trend = CourseDailyStats.query.filter(
+        CourseDailyStats.course_id == course_id,
+        CourseDailyStats.day >= thirty_days_ago,
+        CourseDailyStats.views > 0
+    ).order_by(CourseDailyStats.day).all()
     
     return jsonify({
         "course_id": course_id,
         "views": {
-            "total": views_count,
-            "trend": [{"date": date.strftime("%Y-%m-%d"), "count": count} for date, count in view_trend]
+            "total": stats.views,
+            "trend": [{
+                "date": d.day.strftime("%Y-%m-%d"),
+                "count": d.views,
+                "unique_viewers": d.unique_viewers
+            } for d in view_trend]
         },
         "ratings": {
-            "average": sum(r.rating for r in ratings)/len(ratings) if ratings else 0,
-            "distribution": {str(rating): count for rating, count in rating_dist},
-            "total": len(ratings)
+            "average": stats.rating_sum / stats.rating_count if stats.rating_count else 0,
+            "distribution": {
+                str(bucket): getattr(stats, f"rating_{bucket}")
+                for bucket in RATING_BUCKETS if getattr(stats, f"rating_{bucket}")
+            },
+            "total": stats.rating_count
         }
     })
 
+VIEW_HISTOGRAM_BUCKETS = {'hour': 3600, 'day': DAY}
+VIEW_HISTOGRAM_MAX_DAYS = 365
+
+@app.route('/analytics/course/<int:course_id>/playback', methods=['GET'])
+def get_course_playback(course_id):
+    bucket = max(1, min(request.args.get('bucket', 10, type=int), PLAYBACK_MAX_BUCKET))
+    stats = db.session.get(CoursePlaybackStats, course_id)
+    if not stats or not stats.sessions:
+        return jsonify({"course_id": course_id, "sessions": 0, "bucket_seconds": bucket,
+                        "retention": [], "drop_off": []})
+
+    watched, drop_off = unpack_counts(stats.watched), unpack_counts(stats.drop_off)
+    length = max(len(watched), len(drop_off), stats.duration or 0)
+    watched, drop_off = add_counts(np.zeros(length, dtype=np.int64), watched), add_counts(np.zeros(length, dtype=np.int64), drop_off)
+    starts = np.arange(0, length, bucket)
+    widths = np.diff(np.r_[starts, length])
+    return jsonify({
+        "course_id": course_id,
+        "sessions": stats.sessions,
+        "duration": stats.duration,
+        "average_watch_seconds": round(stats.watch_seconds / stats.sessions, 1),
+        "average_completion": round(stats.completion_sum / stats.completion_sessions, 4) if stats.completion_sessions else None,
+        "completion_rate": round(stats.completed / stats.completion_sessions, 4) if stats.completion_sessions else None,
+        "bucket_seconds": bucket,
+        # Share of sessions playing each bucket, and sessions that stopped in it
+        "retention": np.round(np.add.reduceat(watched, starts) / widths / stats.sessions, 4).tolist() if length else [],
+        "drop_off": np.add.reduceat(drop_off, starts).tolist() if length else []
+    })
+
+@app.route('/analytics/course/<int:course_id>/views', methods=['GET'])
+def get_course_view_histogram(course_id):
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in VIEW_HISTOGRAM_BUCKETS:
+        return jsonify({"error": f"bucket must be one of {', '.join(VIEW_HISTOGRAM_BUCKETS)}"}), 400
+    days = max(1, min(request.args.get('days', 30, type=int), VIEW_HISTOGRAM_MAX_DAYS))
+
+    since = epoch_day_start(days_ago=days - 1)
+    counts = view_archive.histogram(since, since + days * DAY, VIEW_HISTOGRAM_BUCKETS[bucket], course_id)
+    return jsonify({
+        "course_id": course_id,
+        "bucket": bucket,
+        "since": datetime.fromtimestamp(since, timezone.utc).isoformat(),
+        "counts": counts.tolist()
+    })
+
 @app.route('/analytics/recommendations/<int:student_id>', methods=['GET'])
 def get_personalized_recommendations(student_id):
+    precomputed = db.session.get(StudentRecommendation, student_id)
+    recommendations = json.loads(precomputed.course_ids) if precomputed else []
+    if recommendations:
+        return jsonify({
+            "recommendations": recommendations,
+            "generation": precomputed.generation
+        })
+
+    # Students the last batch run did not cover yet, or found nothing for,
+    # get the live path
     try:
-        # Get student's branch from user service
-        student_info = requests.get(f"http://user_service:3001/users/{student_id}").json()
-        branch_response = requests.get(
-            f"http://user_service:3001/users/{student_id}/branch",
-            headers={'Authorization': request.headers.get('Authorization')},
-            timeout=3
-        )
-        branch_id = branch_response.json()['branch_id']
         # Get viewed courses
-        viewed_courses = {v.course_id for v in CourseView.query.filter_by(student_id=student_id).all()}
-        
-        # Get popular courses in branch
-        branch_popular = get_branch_popular_courses(branch_id)
+        viewed_courses = {v.course_id for v in StudentCourseHistory.query.filter_by(student_id=student_id)}
         
         # Get highly rated courses
         top_rated = get_top_rated_courses()
@@ -161,6 +1054,15 @@ def get_personalized_recommendations(student_id):
         # Get frequently paired courses
         paired_courses = get_frequently_paired(viewed_courses)
         
+        # Get popular courses in branch; degrade to the other signals if
+        # the student is unknown locally and user_service is unavailable
+        try:
+            branch_id = get_student_branch(student_id, request.headers.get('Authorization'))
+            branch_popular = get_branch_popular_courses(branch_id) if branch_id is not None else []
+        except Exception as e:
+            logger.warning(f"Branch popularity unavailable: {e}")
+            branch_popular = []
+        
         # Combine and prioritize recommendations
         recommendations = prioritize_recommendations(
             viewed_courses,
@@ -173,71 +1075,301 @@ def get_personalized_recommendations(student_id):
     
     except Exception as e:
         logger.error(f"Recommendation error: {e}")
-        return jsonify({"recom.": get_fallback_recommendations()})
+        return jsonify({"recommendations": get_fallback_recommendations()})
+
+def get_student_branch(student_id, authorization):
+    branch_id = user_branches.get(student_id)
+    if branch_id is not None:
+        return branch_id
+    # Only users not seen on user_events since the directory was created
+    # need a remote lookup; the answer is kept
+    response = http.get(
+        "user",
+        f"/users/{student_id}/branch",
+        headers={'Authorization': authorization} if authorization else {}
+    )
+    response.raise_for_status()
+    branch_id = response.json()['branch_id']
+    record_branches(UserDirectory, 'user_id', user_branches, {student_id: branch_id})
+    return branch_id
+
+# Offline recommendation batch job
+RECOMMENDATION_INTERVAL = 3600  # seconds
+RECOMMENDATION_TOP_N = 10
+ACTIVE_STUDENT_DAYS = 30
+MIN_RATINGS_FOR_TOP_RATED = 5
+BRANCH_LOOKUP_CHUNK = 1000
+recommendation_job_lock = threading.Lock()
+
+def fetch_course_branches(course_ids):
+    """{course_id: branch_id}, from the local directory where possible.
+
+    Courses missing locally (created before the directory existed) are
+    looked up in course_service and recorded, so each is fetched once. If
+    course_service is unavailable the known courses are still returned.
+    """
+    branches = course_branches.get_many(course_ids)
+    missing = sorted(set(course_ids) - set(branches))
+    fetched = {}
+    try:
+        for start in range(0, len(missing), BRANCH_LOOKUP_CHUNK):
+            chunk = missing[start:start + BRANCH_LOOKUP_CHUNK]
+            response = http.get(
+                "course",
+                "/courses/branches",
+                params={"ids": ",".join(map(str, chunk))},
+                timeout=10
+            )
+            response.raise_for_status()
+            fetched.update({int(c): b for c, b in response.json()['branches'].items() if b is not None})
+    except Exception as e:
+        logger.warning(f"Course branch lookup failed for {len(missing)} courses: {e}")
+    record_branches(CourseDirectory, 'course_id', course_branches, fetched)
+    branches.update(fetched)
+    return branches
+
+def precompute_recommendations():
+    """Recompute top-N recommendations for every recently active student."""
+    with app.app_context():
+        since = datetime.now(timezone.utc) - timedelta(days=ACTIVE_STUDENT_DAYS)
+        active = db.session.query(CourseView.student_id).filter(CourseView.timestamp >= since).distinct()
+        views = db.session.query(StudentCourseHistory.student_id, StudentCourseHistory.course_id).filter(
+            StudentCourseHistory.student_id.in_(active)
+        ).all()
+
+        popularity, ratings = {}, {}
+        for stats in CourseStats.query:
+            popularity[stats.course_id] = stats.views
+            if stats.rating_count >= MIN_RATINGS_FOR_TOP_RATED:
+                ratings[stats.course_id] = stats.rating_sum / stats.rating_count
+        candidates = set(popularity) | {c for (c,) in db.session.query(PlaylistMembership.course_id).distinct()}
+
+        results = compute_recommendations(
+            views,
+            fetch_course_branches(candidates),
+            popularity,
+            ratings,
+            lambda course_id: cooccurrence.neighbours(course_id, CooccurrenceModel.MAX_NEIGHBOURS),
+            top_n=RECOMMENDATION_TOP_N
+        )
+
+        generation = int(time.time())
+        # Empty results are not stored, so those students get the live path
+        rows = [{"student_id": student_id, "generation": generation, "course_ids": json.dumps(course_ids)}
+                for student_id, course_ids in results.items() if course_ids]
+        if rows:
+            stmt = sqlite_insert(StudentRecommendation)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['student_id'],
+                set_={"generation": stmt.excluded.generation, "course_ids": stmt.excluded.course_ids,
+                      "created_at": func.current_timestamp()}
+            ), rows)
+        # Students no longer active fall back to the live path
+        StudentRecommendation.query.filter(StudentRecommendation.generation < generation).delete()
+        db.session.commit()
+        logger.info(f"Recommendation generation {generation}: {len(rows)} students")
+        return generation, len(rows)
+
+def run_recommendation_job():
+    if not recommendation_job_lock.acquire(blocking=False):
+        logger.info("Recommendation job already running")
+        return
+    try:
+        precompute_recommendations()
+    except Exception as e:
+        logger.error(f"Recommendation job failed: {e}")
+    finally:
+        recommendation_job_lock.release()
+
+def schedule_recommendations():
+    while True:
+        run_recommendation_job()
+        time.sleep(RECOMMENDATION_INTERVAL)
+
+@app.route('/analytics/recommendations/rebuild', methods=['POST'])
+def rebuild_recommendations():
+    threading.Thread(target=run_recommendation_job, daemon=True).start()
+    return jsonify({"message": "Recommendation rebuild started"}), 202
+
+# Raw event retention: rows older than RETENTION_DAYS are already counted in
+# the rollups, sketches and view archive, so they are folded where needed
+# and deleted in small batches to keep write locks short
+RETENTION_DAYS = max(int(os.getenv('ANALYTICS_RETENTION_DAYS', '90')), ACTIVE_STUDENT_DAYS)
+RETENTION_INTERVAL = DAY
+RETENTION_BATCH = 5000
+RETENTION_PAUSE = 0.05  # seconds between batches, so ingestion gets the lock
+VACUUM_STEP_PAGES = 2000
+retention_job_lock = threading.Lock()
+last_retention_report = {}
+
+def database_bytes():
+    page_size = db.session.execute(text("PRAGMA page_size")).scalar()
+    page_count = db.session.execute(text("PRAGMA page_count")).scalar()
+    return page_size * page_count
+
+def purge_rows(model, column, cutoff, fold=None):
+    """Delete rows whose `column` is before `cutoff`, RETENTION_BATCH at a time.
+
+    Batches walk the rowid, so the whole job is a single pass over the
+    table. `fold` receives each batch before it is deleted, in the same
+    transaction.
+    """
+    table = model.__table__
+    rowid = literal_column('rowid')
+    last, deleted = 0, 0
+    while True:
+        batch = db.session.execute(
+            select(rowid.label('rowid'), table).where(rowid > last, column < cutoff)
+            .order_by(rowid).limit(RETENTION_BATCH)
+        ).mappings().all()
+        if not batch:
+            return deleted
+        if fold:
+            fold(batch)
+        ids = [row['rowid'] for row in batch]
+        db.session.execute(table.delete().where(rowid.in_(ids)))
+        db.session.commit()
+        deleted += len(ids)
+        last = ids[-1]
+        time.sleep(RETENTION_PAUSE)
+
+def fold_playlist_interactions(rows):
+    counts = defaultdict(int)
+    for row in rows:
+        counts[(row['playlist_id'], utc_day(row['timestamp']), row['action'])] += 1
+    upsert_increments(PlaylistDailyStats, ['playlist_id', 'day', 'action'], [
+        {"playlist_id": playlist_id, "day": day, "action": action, "count": count}
+        for (playlist_id, day, action), count in counts.items()
+    ])
+
+def incremental_vacuum():
+    with db.engine.connect() as conn:
+        # Raw sqlite3 connection: its execute() frees a single page per call
+        # of this pragma, executescript() runs it to completion
+        raw = conn.connection.driver_connection
+        if raw.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # Converted by enable_incremental_vacuum() at startup, never here
+            logger.warning("Incremental auto_vacuum is off; freed pages stay in the file until restart")
+            return
+        while raw.execute("PRAGMA freelist_count").fetchone()[0]:
+            raw.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES});")
+            time.sleep(RETENTION_PAUSE)
+        raw.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+def run_retention():
+    """Purge raw events past retention and return what was reclaimed."""
+    with app.app_context():
+        started = time.monotonic()
+        cutoff = datetime.now(timezone.utc) - timedelta(days=RETENTION_DAYS)
+        bytes_before = database_bytes()
+        deleted = {
+            "course_view": purge_rows(CourseView, CourseView.timestamp, cutoff),
+            "course_rating": purge_rows(CourseRating, CourseRating.timestamp, cutoff),
+            "playlist_interaction": purge_rows(
+                PlaylistInteraction, PlaylistInteraction.timestamp, cutoff, fold_playlist_interactions
+            ),
+            "course_daily_viewers": purge_rows(CourseDailyViewer, CourseDailyViewer.day, cutoff.date())
+        }
+        db.session.close()
+        incremental_vacuum()
+        bytes_after = database_bytes()
+        report = {
+            "cutoff": cutoff.isoformat(),
+            "deleted": deleted,
+            "bytes_before": bytes_before,
+            "bytes_after": bytes_after,
+            "reclaimed_bytes": bytes_before - bytes_after,
+            "seconds": round(time.monotonic() - started, 2)
+        }
+        logger.info(f"Retention: {report}")
+        return report
+
+def run_retention_job():
+    global last_retention_report
+    if not retention_job_lock.acquire(blocking=False):
+        logger.info("Retention job already running")
+        return
+    try:
+        last_retention_report = run_retention()
+    except Exception as e:
+        logger.error(f"Retention job failed: {e}")
+    finally:
+        retention_job_lock.release()
+
+def schedule_retention():
+    while True:
+        run_retention_job()
+        time.sleep(RETENTION_INTERVAL)
+
+@app.route('/analytics/retention', methods=['GET'])
+def get_retention_report():
+    return jsonify({
+        "retention_days": RETENTION_DAYS,
+        "running": retention_job_lock.locked(),
+        "last_run": last_retention_report or None
+    })
+
+@app.route('/analytics/retention/run', methods=['POST'])
+def start_retention():
+    threading.Thread(target=run_retention_job, daemon=True).start()
+    return jsonify({"message": "Retention run started"}), 202
 
 def get_fallback_recommendations():
     try:
         # Get top rated courses as fallback
-        top_rated = db.session.query(
-            CourseRating.course_id,
-            func.avg(CourseRating.rating).label('avg_rating')
-        ).group_by(CourseRating.course_id).having(
-            func.count(CourseRating.id) >= 5
-        ).order_by(func.avg(CourseRating.rating).desc()).limit(10).all()
-        
-        return [course_id for course_id, _ in top_rated]
+        return top_rated_course_ids(10)
     except Exception as e:
         logger.error(f"Fallback recommendations failed: {e}")
         return []
 
 def get_branch_popular_courses(branch_id):
-    # Get popular courses in the same branch from course service
-    courses = requests.get(f"http://course_service:3002/courses?branch_id={branch_id}").json()
-    course_ids = [c['id'] for c in courses]
+    return cache.get_or_compute(
+        ('branch_popular', branch_id),
+        lambda: compute_branch_popular_courses(branch_id),
+        ttl=VIEW_CACHE_EXPIRATION
+    )
+
+def compute_branch_popular_courses(branch_id):
+    # Courses in the same branch, from the local directory
+    course_ids = course_branches.ids_in_branch(branch_id)
     
     # Get view counts for these courses
-    views = db.session.query(
-        CourseView.course_id,
-        func.count(CourseView.id).label('views')
-    ).filter(CourseView.course_id.in_(course_ids)).group_by(CourseView.course_id).all()
+    views = db.session.query(CourseStats.course_id, CourseStats.views).filter(
+        CourseStats.course_id.in_(course_ids), CourseStats.views > 0
+    ).all()
     
-    return sorted(views, key=lambda x: x[1], reverse=True)
+    return sorted([tuple(v) for v in views], key=lambda x: x[1], reverse=True)
 
 def get_top_rated_courses():
-    cache_key = 'top_rated'
-    if cache_key in cache:
-        return cache[cache_key]
-    
-    result = db.session.query(
-        CourseRating.course_id,
-        func.avg(CourseRating.rating).label('avg_rating'),
-        func.count(CourseRating.id).label('rating_count')
-    ).group_by(CourseRating.course_id).having(func.count(CourseRating.id) >= 5).order_by(
-        func.avg(CourseRating.rating).desc()
-    ).limit(50).all()
+    # Invalidated by the consumer whenever new ratings are ingested
+    return cache.get_or_compute('top_rated', compute_top_rated_courses)
+
+def compute_top_rated_courses():
+    return top_rated_course_ids(50)
+
+def top_rated_course_ids(limit):
+    # From the rollups, which keep ratings the retention job has purged
+    result = db.session.query(CourseStats.course_id).filter(
+        CourseStats.rating_count >= MIN_RATINGS_FOR_TOP_RATED
+    ).order_by((CourseStats.rating_sum * 1.0 / CourseStats.rating_count).desc()).limit(limit).all()
     
-    cache[cache_key] = [r[0] for r in result]
-    return cache[cache_key]
+    return [r[0] for r in result]
 
-def get_frequently_paired(viewed_courses):
+def get_frequently_paired(viewed_courses, k=20):
+    # Courses that share playlists with what the student has viewed
     if not viewed_courses:
         return []
-        
-    # Find courses frequently paired with viewed courses in playlists
-    paired = db.session.query(
-        PlaylistInteraction.playlist_id,
-        func.group_concat(CourseRating.course_id)
-    ).join(CourseRating, PlaylistInteraction.playlist_id == CourseRating.course_id).filter(
-        CourseRating.course_id.in_(viewed_courses)
-    ).group_by(PlaylistInteraction.playlist_id).all()
-    
-    course_counts = defaultdict(int)
-    for playlist, courses in paired:
-        for course in courses.split(','):
-            if course not in viewed_courses:
-                course_counts[course] += 1
-                
-    return sorted(course_counts.items(), key=lambda x: x[1], reverse=True)
+    return cooccurrence.recommend(viewed_courses, k)
+
+@app.route('/analytics/courses/<int:course_id>/paired', methods=['GET'])
+def get_paired_courses(course_id):
+    k = min(request.args.get('k', 10, type=int), CooccurrenceModel.MAX_NEIGHBOURS)
+    return jsonify({
+        "course_id": course_id,
+        "paired": [{"course_id": other, "score": round(score, 4)}
+                   for other, score in cooccurrence.neighbours(course_id, k)]
+    })
+
 def prioritize_recommendations(viewed, branch_popular, top_rated, paired):
     recommendations = []
     
@@ -256,35 +1388,187 @@ def prioritize_recommendations(viewed, branch_popular, top_rated, paired):
             
     return list(dict.fromkeys(recommendations))  # Remove duplicates
 
+@app.route('/analytics/trending', methods=['GET'])
+def get_trending_courses():
+    window = request.args.get('window', '24h')
+    if window not in trending:
+        return jsonify({"error": f"window must be one of {', '.join(TRENDING_WINDOWS)}"}), 400
+    branch_id = request.args.get('branch_id', type=int)
+    limit = max(1, min(request.args.get('limit', 10, type=int), TRENDING_TOP_K))
+
+    return jsonify({
+        "window": window,
+        "branch_id": branch_id,
+        "courses": [{"course_id": course_id, "score": round(score, 3)}
+                    for course_id, score in trending[window].top(branch_id, limit)]
+    })
+
+def exact_requested():
+    return request.args.get('exact', '').lower() in ('1', 'true', 'yes')
+
+@app.route('/analytics/uniques', methods=['GET'])
+def get_unique_viewers():
+    scope = request.args.get('scope', 'all')
+    if scope not in SKETCH_SCOPES:
+        return jsonify({"error": f"scope must be one of {', '.join(SKETCH_SCOPES)}"}), 400
+    key = request.args.get('id', 0, type=int) if scope != 'all' else 0
+    days = max(1, min(request.args.get('days', 30, type=int), UNIQUES_MAX_DAYS))
+    exact = exact_requested()
+    if exact and days > EXACT_UNIQUES_MAX_DAYS:
+        return jsonify({"error": f"exact counts cover at most {EXACT_UNIQUES_MAX_DAYS} days"}), 400
+
+    daily, total = (exact_uniques if exact else sketch_uniques)(scope, key, days)
+    return jsonify({
+        "scope": scope,
+        "id": key,
+        "exact": exact,
+        "daily": [{"date": day.strftime("%Y-%m-%d"), "count": count} for day, count in daily],
+        "total": total
+    })
+
 @app.route('/analytics/engagement', methods=['GET'])
 def get_engagement_metrics():
-    # Daily active users
-    daily_active = db.session.query(
-        func.date(CourseView.timestamp),
-        func.count(func.distinct(CourseView.student_id))
-    ).filter(CourseView.timestamp >= datetime.now(timezone.utc) - timedelta(days=7)).group_by(
-        func.date(CourseView.timestamp)
-    ).all()
+    # Active users are HyperLogLog estimates unless ?exact=1
+    exact = exact_requested()
+    return jsonify(cache.get_or_compute(
+        ('engagement', exact),
+        lambda: compute_engagement_metrics(exact),
+        ttl=VIEW_CACHE_EXPIRATION
+    ))
+
+def compute_engagement_metrics(exact=False):
+    # Daily and weekly active users over the last 7 days
+    daily_active, weekly_active = (exact_uniques if exact else sketch_uniques)('all', 0, 7)
     
-    # Course completion rates (assuming completion events)
-    # Add your completion tracking logic here
+    # Course completion rates, from finished playback sessions
+    sessions, watch_seconds, completion_sessions, completed = db.session.query(
+        func.sum(CoursePlaybackStats.sessions),
+        func.sum(CoursePlaybackStats.watch_seconds),
+        func.sum(CoursePlaybackStats.completion_sessions),
+        func.sum(CoursePlaybackStats.completed)
+    ).one()
     
-    return jsonify({
-        "daily_active_users": [{"date": date.strftime("%Y-%m-%d"), "count": count} for date, count in daily_active],
+    return {
+        "exact": exact,
+        "daily_active_users": [{"date": day.strftime("%Y-%m-%d"), "count": count} for day, count in daily_active],
         "weekly_engagement": {
-            "total_views": CourseView.query.filter(
-                CourseView.timestamp >= datetime.now(timezone.utc) - timedelta(days=7)
-            ).count(),
+            "active_users": weekly_active,
+            "total_views": view_archive.count(int(time.time()) - 7 * DAY, int(time.time()) + 1),
             "total_ratings": CourseRating.query.filter(
                 CourseRating.timestamp >= datetime.now(timezone.utc) - timedelta(days=7)
             ).count()
+        },
+        "playback": {
+            "sessions": sessions or 0,
+            "watch_seconds": watch_seconds or 0,
+            "completion_rate": round(completed / completion_sessions, 4) if completion_sessions else None
         }
-    })
+    }
+
+# Streaming export. Raw datasets cover the retention window; the daily
+# aggregates go back to the beginning
+EXPORT_DATASETS = {
+    # name: (model, time column, filterable columns)
+    'views': (CourseView, 'timestamp', ('course_id', 'student_id')),
+    'ratings': (CourseRating, 'timestamp', ('course_id', 'student_id')),
+    'playlist_interactions': (PlaylistInteraction, 'timestamp', ('playlist_id', 'student_id')),
+    'course_daily_stats': (CourseDailyStats, 'day', ('course_id',)),
+    'playlist_daily_stats': (PlaylistDailyStats, 'day', ('playlist_id',)),
+}
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+EXPORT_FETCH_ROWS = 2000
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+def parse_export_time(value, column):
+    moment = parse_timestamp(value)
+    if isinstance(column.type, db.Date):
+        return moment.date()
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+def export_lines(query, columns, fmt):
+    """Yield the export body as text lines, fetching rows in small batches."""
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        yield buffer.getvalue()
+    result = db.session.execute(query.execution_options(stream_results=True, yield_per=EXPORT_FETCH_ROWS))
+    for row in result:
+        values = [export_value(v) for v in row]
+        if fmt == 'csv':
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(values)
+            yield buffer.getvalue()
+        else:
+            yield json.dumps(dict(zip(columns, values))) + '\n'
+
+def export_chunks(lines, compress):
+    """Group lines into chunks of about EXPORT_CHUNK_BYTES, gzipped if asked.
+
+    The first line is sent on its own so the client gets a response at
+    once, however long the query takes to produce the rest.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    pending, size, first = [], 0, True
+    for line in lines:
+        pending.append(line)
+        size += len(line)
+        if first or size >= EXPORT_CHUNK_BYTES:
+            data = ''.join(pending).encode()
+            yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else data
+            pending, size, first = [], 0, False
+    data = ''.join(pending).encode()
+    yield compressor.compress(data) + compressor.flush() if compressor else data
+
+@app.route('/analytics/export', methods=['GET'])
+def export_analytics():
+    dataset = request.args.get('dataset', 'views')
+    if dataset not in EXPORT_DATASETS:
+        return jsonify({"error": f"dataset must be one of {', '.join(EXPORT_DATASETS)}"}), 400
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(EXPORT_FORMATS)}"}), 400
+    compress = request.args.get('gzip', '').lower() in ('1', 'true', 'yes')
+
+    model, time_column, filterable = EXPORT_DATASETS[dataset]
+    table = model.__table__
+    query = select(table)
+    try:
+        if request.args.get('since'):
+            query = query.where(table.c[time_column] >= parse_export_time(request.args['since'], table.c[time_column]))
+        if request.args.get('until'):
+            query = query.where(table.c[time_column] < parse_export_time(request.args['until'], table.c[time_column]))
+    except ValueError:
+        return jsonify({"error": "since and until must be ISO 8601 dates or datetimes"}), 400
+    for name in filterable:
+        value = request.args.get(name, type=int)
+        if value is not None:
+            query = query.where(table.c[name] == value)
+    # Primary key order streams straight off the table without a sort
+    query = query.order_by(*table.primary_key.columns)
+
+    columns = [c.name for c in table.columns]
+    filename = f"{dataset}.{fmt}" + ('.gz' if compress else '')
+    return Response(
+        stream_with_context(export_chunks(export_lines(query, columns, fmt), compress)),
+        mimetype='application/gzip' if compress else EXPORT_FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
 
 # Start RabbitMQ consumer
 consumer_thread = threading.Thread(target=consume_user_interactions)
 consumer_thread.daemon = True
 consumer_thread.start()
+threading.Thread(target=consume_directory_events, daemon=True).start()
+threading.Thread(target=schedule_recommendations, daemon=True).start()
+threading.Thread(target=schedule_retention, daemon=True).start()
+threading.Thread(target=sweep_playback_sessions, daemon=True).start()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=3005)
\ No newline at end of file
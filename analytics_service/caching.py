@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Flight:
+    """A computation in progress that other callers can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self.stale = False
+
+
+class TTLCache:
+    """Thread-safe LRU cache with per-key TTL and single-flight recompute.
+
+    When a key is missing or expired, exactly one caller computes it; other
+    callers asking for the same key wait for that result instead of
+    recomputing it themselves. Invalidating a key while it is being computed
+    stops the (possibly stale) result from being stored.
+    """
+
+    def __init__(self, max_size=1024, default_ttl=300):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute, ttl=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                return entry[1]
+
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.error is None and not flight.stale:
+                    self._store(key, flight.value, ttl)
+            flight.done.set()
+        return flight.value
+
+    def _store(self, key, value, ttl):
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, match):
+        """Drop every key equal to `match`, or whose first element is `match`
+        for tuple keys (so `invalidate('branch_popular')` drops all branches)."""
+        with self._lock:
+            matches = lambda k: k == match or (isinstance(k, tuple) and k and k[0] == match)
+            for key in [k for k in self._entries if matches(k)]:
+                del self._entries[key]
+            for key, flight in self._flights.items():
+                if matches(key):
+                    flight.stale = True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            for flight in self._flights.values():
+                flight.stale = True
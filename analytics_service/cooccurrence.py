@@ -0,0 +1,124 @@
+import heapq
+import math
+import threading
+from collections import Counter, defaultdict
+
+
+class CooccurrenceModel:
+    """Sparse course x course co-occurrence counts over playlists.
+
+    Rows are stored as dicts of non-zero entries (a dictionary-of-keys
+    sparse matrix), so adding or removing one course from a playlist only
+    touches the rows of that playlist's courses. Similarity is cosine
+    normalized: count(a, b) / sqrt(playlists(a) * playlists(b)).
+    Ranked neighbour lists are cached per course and dropped whenever a
+    change can affect them, so repeated top-k reads are dictionary lookups.
+    """
+
+    MAX_NEIGHBOURS = 50
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._playlists = defaultdict(set)  # playlist id -> course ids
+        self._rows = defaultdict(dict)  # course id -> {course id: co-count}
+        self._occurrences = Counter()  # course id -> number of playlists
+        self._ranked = {}  # course id -> [(course id, score)], best first
+
+    def load(self, memberships):
+        """Build the model from (playlist_id, course_id) pairs, replacing
+        whatever it held before."""
+        with self._lock:
+            self._playlists.clear()
+            self._rows.clear()
+            self._occurrences.clear()
+            for playlist_id, course_id in memberships:
+                self._add(playlist_id, course_id)
+            self._ranked.clear()
+
+    def add(self, playlist_id, course_id):
+        with self._lock:
+            self._add(playlist_id, course_id)
+
+    def remove(self, playlist_id, course_id):
+        with self._lock:
+            self._remove(playlist_id, course_id)
+
+    def remove_course(self, course_id):
+        """Drop a course from every playlist, e.g. when it is deleted."""
+        with self._lock:
+            for playlist_id, courses in list(self._playlists.items()):
+                if course_id in courses:
+                    self._remove(playlist_id, course_id)
+
+    def _add(self, playlist_id, course_id):
+        courses = self._playlists[playlist_id]
+        if course_id in courses:
+            return
+        row = self._rows[course_id]
+        for other in courses:
+            row[other] = row.get(other, 0) + 1
+            other_row = self._rows[other]
+            other_row[course_id] = other_row.get(course_id, 0) + 1
+        courses.add(course_id)
+        self._occurrences[course_id] += 1
+        self._invalidate(course_id)
+
+    def _remove(self, playlist_id, course_id):
+        courses = self._playlists.get(playlist_id)
+        if not courses or course_id not in courses:
+            return
+        # Invalidate before the row shrinks so former neighbours are included
+        self._invalidate(course_id)
+        courses.discard(course_id)
+        for other in courses:
+            for a, b in ((course_id, other), (other, course_id)):
+                row = self._rows[a]
+                row[b] -= 1
+                if not row[b]:
+                    del row[b]
+            if not self._rows[other]:
+                del self._rows[other]
+        if not self._rows.get(course_id, True):
+            del self._rows[course_id]
+        self._occurrences[course_id] -= 1
+        if not self._occurrences[course_id]:
+            del self._occurrences[course_id]
+        if not courses:
+            del self._playlists[playlist_id]
+
+    def _invalidate(self, course_id):
+        # The course's own ranking and, since its occurrence count feeds the
+        # normalization, the ranking of every course it co-occurs with
+        self._ranked.pop(course_id, None)
+        for other in self._rows.get(course_id, ()):
+            self._ranked.pop(other, None)
+
+    def _rank(self, course_id):
+        ranked = self._ranked.get(course_id)
+        if ranked is None:
+            row = self._rows.get(course_id, {})
+            n = self._occurrences[course_id]
+            scored = ((other, count / math.sqrt(n * self._occurrences[other]))
+                      for other, count in row.items())
+            ranked = heapq.nlargest(self.MAX_NEIGHBOURS, scored, key=lambda item: (item[1], -item[0]))
+            self._ranked[course_id] = ranked
+        return ranked
+
+    def neighbours(self, course_id, k=10):
+        """Top-k (course_id, similarity) pairs for one course."""
+        with self._lock:
+            return self._rank(course_id)[:k]
+
+    def recommend(self, course_ids, k=10):
+        """Courses most similar to a set of courses, excluding the set itself.
+
+        Similarities to each course in the set are summed per candidate.
+        """
+        course_ids = set(course_ids)
+        scores = defaultdict(float)
+        with self._lock:
+            for course_id in course_ids:
+                for other, score in self._rank(course_id):
+                    if other not in course_ids:
+                        scores[other] += score
+        return heapq.nlargest(k, scores.items(), key=lambda item: (item[1], -item[0]))
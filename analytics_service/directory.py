@@ -0,0 +1,79 @@
+import threading
+
+import numpy as np
+
+
+class BranchDirectory:
+    """Compact id -> branch_id map stored as an array indexed by id.
+
+    Lookups are a single array read and "all ids in a branch" is one
+    vectorized comparison. Ids are small autoincrement integers, so the
+    array stays dense; it grows by doubling when a larger id shows up.
+    """
+
+    UNKNOWN = -1
+
+    def __init__(self, initial_size=1024):
+        self._branches = np.full(initial_size, self.UNKNOWN, dtype=np.int32)
+        self._lock = threading.Lock()
+
+    def _ensure_capacity(self, entity_id):
+        size = len(self._branches)
+        if entity_id < size:
+            return
+        while size <= entity_id:
+            size *= 2
+        grown = np.full(size, self.UNKNOWN, dtype=np.int32)
+        grown[:len(self._branches)] = self._branches
+        self._branches = grown
+
+    def load(self, pairs):
+        """Bulk load (id, branch_id) pairs."""
+        pairs = [(i, b) for i, b in pairs if b is not None]
+        if not pairs:
+            return
+        ids, branches = np.array(pairs, dtype=np.int64).T
+        with self._lock:
+            self._ensure_capacity(int(ids.max()))
+            self._branches[ids] = branches
+
+    def set(self, entity_id, branch_id):
+        if branch_id is None:
+            self.remove(entity_id)
+            return
+        with self._lock:
+            self._ensure_capacity(entity_id)
+            self._branches[entity_id] = branch_id
+
+    def remove(self, entity_id):
+        with self._lock:
+            if 0 <= entity_id < len(self._branches):
+                self._branches[entity_id] = self.UNKNOWN
+
+    def get(self, entity_id):
+        """Branch id, or None when the id is not in the directory."""
+        branches = self._branches
+        if 0 <= entity_id < len(branches) and branches[entity_id] != self.UNKNOWN:
+            return int(branches[entity_id])
+        return None
+
+    def get_many(self, entity_ids):
+        """{id: branch_id} for the ids that are in the directory."""
+        branches = self._branches
+        ids = np.fromiter(entity_ids, dtype=np.int64)
+        ids = ids[(ids >= 0) & (ids < len(branches))]
+        found = branches[ids]
+        known = found != self.UNKNOWN
+        return dict(zip(ids[known].tolist(), found[known].tolist()))
+
+    def lookup(self, entity_ids):
+        """Array of branch ids aligned with `entity_ids`, UNKNOWN where missing."""
+        branches = self._branches
+        ids = np.asarray(entity_ids, dtype=np.int64)
+        inside = (ids >= 0) & (ids < len(branches))
+        found = np.full(len(ids), self.UNKNOWN, dtype=np.int32)
+        found[inside] = branches[ids[inside]]
+        return found
+
+    def ids_in_branch(self, branch_id):
+        return np.flatnonzero(self._branches == branch_id).tolist()
@@ -0,0 +1,199 @@
+import os
+import threading
+
+import numpy as np
+
+DAY = 86400
+
+# Column name -> dtype; each column of a segment is its own append-only file
+COLUMNS = {
+    'course': np.int32,
+    'student': np.int32,
+    'ts': np.int64,  # seconds since the epoch, UTC
+}
+
+
+class _Segment:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.sealed = False
+        self.min_ts = None
+        self.max_ts = None
+        self.ordered = True  # timestamps never decrease, so ranges are slices
+        self._mapped = None
+
+    def path(self, column):
+        return f"{self.prefix}.{column}"
+
+    def __len__(self):
+        # Columns are appended one after the other, so after a crash they
+        # can differ in length; only complete rows count
+        return min(os.path.getsize(self.path(c)) // np.dtype(t).itemsize for c, t in COLUMNS.items())
+
+    def columns(self):
+        """{column: array} memory-mapped read-only. Sealed segments are
+        mapped once; the active one is remapped as it grows."""
+        if self._mapped is not None:
+            return self._mapped
+        n = len(self)
+        if not n:
+            return {c: np.empty(0, dtype=t) for c, t in COLUMNS.items()}
+        mapped = {c: np.memmap(self.path(c), dtype=t, mode='r', shape=(n,)) for c, t in COLUMNS.items()}
+        if self.sealed:
+            self._mapped = mapped
+        return mapped
+
+    def load_bounds(self):
+        ts = self.columns()['ts']
+        if len(ts):
+            self.min_ts, self.max_ts = int(ts.min()), int(ts.max())
+            self.ordered = bool(np.all(ts[1:] >= ts[:-1]))
+
+    def overlaps(self, since, until):
+        return self.min_ts is not None and self.min_ts < until and self.max_ts >= since
+
+
+class ViewArchive:
+    """Append-only columnar store of course views.
+
+    Events are appended to fixed-size segments, one file per column
+    (int32 course ids, int32 student ids, int64 timestamps), which are
+    memory-mapped and scanned with NumPy. Segments keep their timestamp
+    range so time-bounded queries skip segments outside it, and the page
+    cache rather than the Python heap holds the data.
+    """
+
+    def __init__(self, directory, segment_events=1 << 22):
+        self.directory = directory
+        self.segment_events = segment_events
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        names = sorted({f.split('.')[0] for f in os.listdir(directory) if f.split('.')[0].isdigit()})
+        self._segments = [_Segment(os.path.join(directory, name)) for name in names]
+        for segment in self._segments[:-1]:
+            segment.sealed = True
+        for segment in self._segments:
+            self._repair(segment)
+            segment.load_bounds()
+
+    def _repair(self, segment):
+        # Drop a partial row left behind by an interrupted append
+        n = len(segment) if all(os.path.exists(segment.path(c)) for c in COLUMNS) else 0
+        for column, dtype in COLUMNS.items():
+            with open(segment.path(column), 'ab') as f:
+                f.truncate(n * np.dtype(dtype).itemsize)
+
+    def _new_segment(self):
+        if self._segments:
+            self._segments[-1].sealed = True
+        segment = _Segment(os.path.join(self.directory, f"{len(self._segments) + 1:06d}"))
+        self._repair(segment)
+        self._segments.append(segment)
+        return segment
+
+    def __len__(self):
+        return sum(len(segment) for segment in self._segments)
+
+    def append(self, course_ids, student_ids, timestamps):
+        """Append a batch of views given as three equal-length sequences."""
+        batch = {
+            'course': np.asarray(course_ids, dtype=np.int32),
+            'student': np.asarray(student_ids, dtype=np.int32),
+            'ts': np.asarray(timestamps, dtype=np.int64),
+        }
+        total = len(batch['ts'])
+        with self._lock:
+            start = 0
+            while start < total:
+                segment = self._segments[-1] if self._segments else self._new_segment()
+                room = self.segment_events - len(segment)
+                if room <= 0:
+                    segment = self._new_segment()
+                    room = self.segment_events
+                end = min(total, start + room)
+                for column in COLUMNS:
+                    with open(segment.path(column), 'ab') as f:
+                        f.write(batch[column][start:end].tobytes())
+                chunk = batch['ts'][start:end]
+                lo, hi = int(chunk.min()), int(chunk.max())
+                segment.ordered = (segment.ordered and bool(np.all(chunk[1:] >= chunk[:-1]))
+                                   and (segment.max_ts is None or lo >= segment.max_ts))
+                segment.min_ts = lo if segment.min_ts is None else min(segment.min_ts, lo)
+                segment.max_ts = hi if segment.max_ts is None else max(segment.max_ts, hi)
+                start = end
+
+    def scan(self, since, until, course_id=None):
+        """Yield (course, student, ts, ordered) arrays of views in [since, until).
+
+        `course_id` restricts the views to one course or a list of courses.
+        `ordered` means ts is sorted, so sub-ranges can be found by binary
+        search instead of arithmetic on every element.
+        """
+        with self._lock:
+            segments = [(s, s.ordered) for s in self._segments if s.overlaps(since, until)]
+        for segment, ordered in segments:
+            cols = segment.columns()
+            course, student, ts = cols['course'], cols['student'], cols['ts']
+            if ordered:
+                lo, hi = np.searchsorted(ts, [since, until])
+                course, student, ts = course[lo:hi], student[lo:hi], ts[lo:hi]
+            elif not (segment.min_ts >= since and segment.max_ts < until):
+                mask = (ts >= since) & (ts < until)
+                course, student, ts = course[mask], student[mask], ts[mask]
+            if course_id is not None:
+                match = np.isin(course, course_id) if np.ndim(course_id) else course == course_id
+                course, student, ts = course[match], student[match], ts[match]
+            yield course, student, ts, ordered
+
+    def count(self, since, until, course_id=None):
+        return sum(len(ts) for _, _, ts, _ in self.scan(since, until, course_id))
+
+    def histogram(self, since, until, bucket=DAY, course_id=None):
+        """View counts per `bucket` seconds from `since`, optionally for one course."""
+        buckets = -(-(until - since) // bucket)
+        counts = np.zeros(buckets, dtype=np.int64)
+        edges = since + bucket * np.arange(buckets + 1)
+        for _, _, ts, ordered in self.scan(since, until, course_id):
+            if ordered:
+                counts += np.diff(np.searchsorted(ts, edges))
+            else:
+                counts += np.bincount((ts - since) // bucket, minlength=buckets)
+        return counts
+
+    def views_per_course(self, since, until):
+        """{course_id: views} over a time range."""
+        counts = np.zeros(0, dtype=np.int64)
+        for course, _, _, _ in self.scan(since, until):
+            found = np.bincount(course)
+            if len(found) > len(counts):
+                found[:len(counts)] += counts
+                counts = found
+            else:
+                counts[:len(found)] += found
+        ids = np.flatnonzero(counts)
+        return dict(zip(ids.tolist(), counts[ids].tolist()))
+
+    def unique_students(self, since, until, course_id=None):
+        """Exact number of distinct students over a time range.
+
+        Memory follows the number of distinct students, not the id range.
+        """
+        seen = np.zeros(0, dtype=np.int32)
+        for _, student, _, _ in self.scan(since, until, course_id):
+            if len(student):
+                seen = np.union1d(seen, student)
+        return len(seen)
+
+    def daily_active_users(self, since, until, course_id=None):
+        """Distinct students per UTC day; `since` should be at midnight.
+
+        Each view becomes a (day << 32 | student) key and the keys are
+        deduplicated segment by segment, so memory follows the number of
+        distinct (day, student) pairs rather than days times the id range.
+        """
+        days = -(-(until - since) // DAY)
+        seen = np.zeros(0, dtype=np.int64)
+        for _, student, ts, _ in self.scan(since, until, course_id):
+            if len(student):
+                seen = np.union1d(seen, (((ts - since) // DAY) << 32) | student.astype(np.int64))
+        return np.bincount(seen >> 32, minlength=days)
@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a downstream service that keeps failing."""
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures.
+
+    While open, calls fail immediately. After `reset_timeout` seconds one
+    trial call is let through (half-open): success closes the circuit,
+    failure opens it again.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                raise CircuitOpenError(f"{self.name} circuit is open")
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(f"Opening circuit for {self.name}")
+                self._opened_at = time.monotonic()
+
+
+class ServiceClient:
+    """Shared outbound HTTP client for calls to the other services.
+
+    One pooled keep-alive session serves every call, each service has its
+    own circuit breaker, and every call has a timeout.
+    """
+
+    def __init__(self, services, timeout=3, pool_size=20):
+        self.services = services  # name -> base URL
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(services), pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.breakers = {name: CircuitBreaker(name) for name in services}
+
+    def get(self, service, path, timeout=None, **kwargs):
+        """GET a path on a service. 5xx responses and connection errors count
+        as failures for the breaker; 4xx responses are returned as-is."""
+        breaker = self.breakers[service]
+        breaker.before_call()
+        try:
+            response = self.session.get(
+                self.services[service] + path,
+                timeout=self.timeout if timeout is None else timeout,
+                **kwargs
+            )
+        except requests.RequestException:
+            breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
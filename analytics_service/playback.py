@@ -0,0 +1,80 @@
+import threading
+
+import numpy as np
+
+
+class _Session:
+    def __init__(self, course_id, student_id, timestamp, position):
+        self.course_id = course_id
+        self.student_id = student_id
+        self.watched = np.zeros(max(position + 1, 64), dtype=bool)
+        self.duration = None
+        self.last_ts = timestamp
+        self.last_position = position
+        self.last_state = None
+
+    def mark(self, start, end):
+        if end > len(self.watched):
+            self.watched = np.pad(self.watched, (0, max(end, 2 * len(self.watched)) - len(self.watched)))
+        self.watched[start:end] = True
+
+
+class PlaybackSessionizer:
+    """Turns sampled playback heartbeats into finished viewing sessions.
+
+    Heartbeats are grouped per (student, course). Between two consecutive
+    heartbeats of a playing session, the seconds from the old position to
+    the new one count as watched when the position advanced no faster than
+    wall-clock time allows; anything else is a seek or a pause and only
+    moves the cursor. A session ends on an 'ended' heartbeat, or once it
+    has been idle for `gap` seconds.
+    """
+
+    MAX_RATE = 2.0  # fastest playback speed still counted as watching
+
+    def __init__(self, gap=600, max_seconds=6 * 3600):
+        self.gap = gap
+        self.max_seconds = max_seconds
+        self._open = {}  # (student_id, course_id) -> _Session
+        self._lock = threading.Lock()
+
+    def add(self, heartbeats):
+        """Feed heartbeat dicts (course_id, student_id, ts, position, duration,
+        state); returns the sessions this closed."""
+        finished = []
+        with self._lock:
+            for beat in sorted(heartbeats, key=lambda b: b['ts']):
+                key = (beat['student_id'], beat['course_id'])
+                position = min(max(int(beat['position']), 0), self.max_seconds)
+                session = self._open.get(key)
+                if session is not None and beat['ts'] - session.last_ts > self.gap:
+                    finished.append(self._open.pop(key))
+                    session = None
+                if session is None:
+                    session = self._open[key] = _Session(beat['course_id'], beat['student_id'], beat['ts'], position)
+                else:
+                    elapsed = beat['ts'] - session.last_ts
+                    advanced = position - session.last_position
+                    if session.last_state != 'paused' and 0 < advanced <= elapsed * self.MAX_RATE + 1:
+                        session.mark(session.last_position, position)
+                    session.last_ts = max(session.last_ts, beat['ts'])
+                    session.last_position = position
+                if beat.get('duration'):
+                    session.duration = min(int(beat['duration']), self.max_seconds)
+                session.last_state = beat.get('state')
+                if session.last_state == 'ended':
+                    finished.append(self._open.pop(key))
+        return finished
+
+    def expire(self, now):
+        """Close and return the sessions idle for longer than `gap`."""
+        with self._lock:
+            idle = [key for key, session in self._open.items() if now - session.last_ts > self.gap]
+            return [self._open.pop(key) for key in idle]
+
+
+def summarize(session):
+    """(watched seconds, completion in [0, 1] or None, drop-off position)."""
+    watched = int(session.watched.sum())
+    completion = min(watched / session.duration, 1.0) if session.duration else None
+    return watched, completion, session.last_position
@@ -0,0 +1,122 @@
+from collections import defaultdict
+
+import numpy as np
+
+# Relative weight of each signal in the combined score
+PAIRED_WEIGHT = 3.0
+POPULARITY_WEIGHT = 2.0
+RATING_WEIGHT = 1.0
+
+
+def compute_recommendations(views, course_branches, popularity, ratings, neighbours,
+                            top_n=10, chunk_size=1024):
+    """Rank unseen courses for every student in `views`.
+
+    views: iterable of distinct (student_id, course_id) pairs
+    course_branches: {course_id: branch_id} for every candidate course
+    popularity: {course_id: view count}
+    ratings: {course_id: average rating}, only for courses with enough ratings
+    neighbours: callable returning [(course_id, similarity)] for a course
+
+    Students are assigned to the branch most of their viewed courses belong
+    to, and only courses of that branch are candidates. Scoring is done per
+    branch for blocks of at most `chunk_size` students:
+
+        score = PAIRED * (viewed @ similarity) + POPULARITY * pop / max(pop)
+                + RATING * rating / 5
+
+    with already-viewed courses excluded. The similarity matrix is kept
+    sparse, one row of at most len(neighbours()) entries per course, and
+    only the non-zero products are formed, so memory and time grow with
+    the neighbour lists rather than the square of the catalogue. A course
+    outside every neighbour list scores its base term alone, so besides
+    the neighbours only the best `top_n + viewed` courses by base score
+    can make the top n. Returns {student_id: [course_id]}.
+    """
+    pairs = np.array([(s, c) for s, c in views if c in course_branches], dtype=np.int64)
+    if not len(pairs):
+        return {}
+    pair_branches = np.array([course_branches[c] for c in pairs[:, 1]], dtype=np.int64)
+
+    # Home branch per student: the branch with the most viewed courses
+    sb, counts = np.unique(np.stack([pairs[:, 0], pair_branches], axis=1), axis=0, return_counts=True)
+    order = np.lexsort((-counts, sb[:, 0]))
+    sb = sb[order]
+    first = np.ones(len(sb), dtype=bool)
+    first[1:] = sb[1:, 0] != sb[:-1, 0]
+    home_branch = dict(zip(sb[first, 0].tolist(), sb[first, 1].tolist()))
+
+    courses_by_branch = defaultdict(list)
+    for course_id, branch_id in course_branches.items():
+        courses_by_branch[branch_id].append(course_id)
+
+    viewed_by_student = defaultdict(list)
+    for student_id, course_id in pairs.tolist():
+        if course_branches[course_id] == home_branch[student_id]:
+            viewed_by_student[student_id].append(course_id)
+
+    students_by_branch = defaultdict(list)
+    for student_id, branch_id in home_branch.items():
+        students_by_branch[branch_id].append(student_id)
+
+    results = {}
+    for branch_id, students in students_by_branch.items():
+        course_ids = np.array(sorted(courses_by_branch[branch_id]), dtype=np.int64)
+        column = {course_id: i for i, course_id in enumerate(course_ids.tolist())}
+        n_courses = len(course_ids)
+
+        pop = np.array([popularity.get(c, 0) for c in course_ids.tolist()], dtype=np.float32)
+        if pop.max() > 0:
+            pop /= pop.max()
+        rating = np.array([ratings.get(c, 0) for c in course_ids.tolist()], dtype=np.float32) / 5
+        base = POPULARITY_WEIGHT * pop + RATING_WEIGHT * rating
+
+        # CSR rows: neighbours of course i are indices/data[indptr[i]:indptr[i + 1]]
+        indptr, indices, data = [0], [], []
+        for course_id in course_ids.tolist():
+            for other, score in neighbours(course_id):
+                j = column.get(other)
+                if j is not None:
+                    indices.append(j)
+                    data.append(score)
+            indptr.append(len(indices))
+        indptr = np.array(indptr, dtype=np.int64)
+        indices = np.array(indices, dtype=np.int64)
+        data = PAIRED_WEIGHT * np.array(data, dtype=np.float32)
+        by_base = np.argsort(-base, kind='stable')
+
+        for start in range(0, len(students), chunk_size):
+            chunk = students[start:start + chunk_size]
+            lengths = np.array([len(viewed_by_student[s]) for s in chunk], dtype=np.int64)
+            viewed_rows = np.repeat(np.arange(len(chunk), dtype=np.int64), lengths)
+            viewed_cols = np.array([column[c] for s in chunk for c in viewed_by_student[s]], dtype=np.int64)
+
+            # Non-zero terms of viewed @ similarity, one per (viewed course, neighbour)
+            counts = indptr[viewed_cols + 1] - indptr[viewed_cols]
+            offsets = np.repeat(indptr[viewed_cols] - (np.cumsum(counts) - counts), counts)
+            positions = offsets + np.arange(counts.sum(), dtype=np.int64)
+            pair_rows = np.repeat(viewed_rows, counts)
+
+            # Plus the best courses by base score, with no paired term
+            m = min(n_courses, top_n + int(lengths.max()))
+            base_rows = np.repeat(np.arange(len(chunk), dtype=np.int64), m)
+            base_cols = np.tile(by_base[:m], len(chunk))
+
+            keys = np.concatenate([pair_rows * n_courses + indices[positions], base_rows * n_courses + base_cols])
+            weights = np.concatenate([data[positions], np.zeros(len(base_rows), dtype=np.float32)])
+            keys, inverse = np.unique(keys, return_inverse=True)
+            rows, cols = keys // n_courses, keys % n_courses
+            scores = np.bincount(inverse, weights=weights) + base[cols]
+
+            keep = (scores > 0) & ~np.isin(keys, viewed_rows * n_courses + viewed_cols)
+            rows, cols, scores = rows[keep], cols[keep], scores[keep]
+            order = np.lexsort((course_ids[cols], -scores, rows))
+            rows, cols = rows[order], cols[order]
+            rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+            top = rank < top_n
+            ranked = defaultdict(list)
+            for row, col in zip(rows[top].tolist(), course_ids[cols[top]].tolist()):
+                ranked[row].append(col)
+            for row, student_id in enumerate(chunk):
+                results[student_id] = ranked.get(row, [])
+    return results
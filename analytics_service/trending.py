@@ -0,0 +1,109 @@
+import heapq
+import math
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+
+
+class DecayedTopK:
+    """Top-k keys by exponentially decayed count, kept per group.
+
+    An event at time t counts exp(-(now - t) / lifetime), so a key's score
+    approximates its events over the last `lifetime` seconds. Scores are
+    stored relative to a fixed landmark time instead of being decayed on
+    every read: all of them shrink by the same factor as time passes, so
+    the ranking never changes between events and reads only scale the k
+    stored values.
+
+    Scores only grow between rescales, so a key can only enter the top k
+    when it is itself incremented; the top k of each group is maintained on
+    every increment and reading it never touches the other keys.
+    """
+
+    RESCALE_AFTER = 50  # lifetimes; keeps exp() far from float overflow
+    PRUNE_BELOW = 1e-3  # decayed scores under this are dropped on rescale
+
+    def __init__(self, lifetime, k=50):
+        self.lifetime = lifetime
+        self.k = k
+        self._landmark = time.time()
+        self._scores = defaultdict(dict)  # group -> {key: landmark score}
+        self._top = defaultdict(dict)  # group -> {key: landmark score}, the k best
+        self._floor = {}  # group -> weakest key of its top k, when known
+        self._lock = threading.Lock()
+
+    def add_many(self, keys, timestamps, groups=None):
+        """Count one event per (key, timestamp), in `groups` or the None group."""
+        keys = np.asarray(keys, dtype=np.int64)
+        if not len(keys):
+            return
+        now = time.time()
+        with self._lock:
+            if now - self._landmark > self.RESCALE_AFTER * self.lifetime:
+                self._rescale(now)
+            ts = np.minimum(np.asarray(timestamps, dtype=np.float64), now)
+            weights = np.exp((ts - self._landmark) / self.lifetime)
+            if groups is None:
+                unique, inverse = np.unique(keys, return_inverse=True)
+                totals = np.bincount(inverse, weights=weights)
+                for key, amount in zip(unique.tolist(), totals.tolist()):
+                    self._bump(None, key, amount)
+            else:
+                pairs = np.stack([np.asarray(groups, dtype=np.int64), keys], axis=1)
+                unique, inverse = np.unique(pairs, axis=0, return_inverse=True)
+                totals = np.bincount(inverse.ravel(), weights=weights)
+                for (group, key), amount in zip(unique.tolist(), totals.tolist()):
+                    self._bump(group, key, amount)
+
+    def _bump(self, group, key, amount):
+        scores = self._scores[group]
+        value = scores[key] = scores.get(key, 0.0) + amount
+        top = self._top[group]
+        if key in top or len(top) < self.k:
+            top[key] = value
+            if self._floor.get(group) == key:
+                del self._floor[group]
+            return
+        floor = self._floor.get(group)
+        if floor is None:
+            floor = self._floor[group] = min(top, key=top.get)
+        if value > top[floor]:
+            del top[floor]
+            top[key] = value
+            del self._floor[group]
+
+    def _rescale(self, now):
+        factor = math.exp((self._landmark - now) / self.lifetime)
+        for group, scores in list(self._scores.items()):
+            kept = {key: value * factor for key, value in scores.items() if value * factor >= self.PRUNE_BELOW}
+            if kept:
+                self._scores[group] = kept
+                self._top[group] = dict(heapq.nlargest(self.k, kept.items(), key=lambda item: item[1]))
+            else:
+                del self._scores[group]
+                self._top.pop(group, None)
+        self._floor.clear()
+        self._landmark = now
+
+    def remove(self, key):
+        """Forget a key everywhere, e.g. a deleted course."""
+        with self._lock:
+            for group, scores in self._scores.items():
+                scores.pop(key, None)
+                top = self._top[group]
+                if top.pop(key, None) is not None:
+                    self._floor.pop(group, None)
+                    # Promote the best key that was just outside the top k
+                    outside = ((k, v) for k, v in scores.items() if k not in top)
+                    best = max(outside, key=lambda item: item[1], default=None)
+                    if best:
+                        top[best[0]] = best[1]
+
+    def top(self, group=None, n=10):
+        """[(key, decayed score)] for the n best keys of a group, best first."""
+        with self._lock:
+            decay = math.exp((self._landmark - time.time()) / self.lifetime)
+            ranked = sorted(self._top.get(group, {}).items(), key=lambda item: (-item[1], item[0]))
+        return [(key, value * decay) for key, value in ranked[:n]]
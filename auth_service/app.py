@@ -3,13 +3,15 @@ from flask import Flask, request, jsonify
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_sqlalchemy import SQLAlchemy
 import pika
-import json
 import logging
 from auth_lib import generate_token, decode_token  # Import from your auth_lib
+from messaging import DedupeStore, IdempotentConsumer, Publisher, PublishError
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+SERVICE_NAME = 'auth_service'  # origin stamped on published events
+
 app = Flask(__name__)
 
 # App configuration
@@ -29,17 +31,19 @@ class AuthUser(db.Model):
 # Create the database tables if they don't exist
 with app.app_context():
     db.create_all()
+    # USER_CREATED events published here come back on our own queue
+    consumer = IdempotentConsumer(SERVICE_NAME, DedupeStore(db.engine))
 
 # RabbitMQ Publisher
+# user_events is a fanout exchange so each consuming service gets every event
+# on its own queue; the user_events queue stays bound for user_service.
+publisher = Publisher(host='rabbitmq', origin=SERVICE_NAME).declare_fanout('user_events', ['user_events'])
+
 def publish_message(queue, message):
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
-        channel = connection.channel()
-        channel.queue_declare(queue=queue, durable=True)
-        channel.basic_publish(exchange='', routing_key=queue, body=json.dumps(message))
-        connection.close()
+        publisher.publish(queue, message)
         logger.info(f"Message published to queue '{queue}': {message}")
-    except Exception as e:
+    except PublishError as e:
         logger.error(f"Failed to publish message: {e}")
 
 # Route to register a new user
@@ -106,26 +110,33 @@ def consume_user_events():
     try:
         connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
         channel = connection.channel()
-        channel.queue_declare(queue='user_events', durable=True)
+        channel.exchange_declare(exchange='user_events', exchange_type='fanout', durable=True)
+        channel.queue_declare(queue='auth_service.user_events', durable=True)
+        channel.queue_bind(queue='auth_service.user_events', exchange='user_events')
 
-        def callback(ch, method, properties, body):
-            event = json.loads(body)
+        def apply_event(event):
             logger.info(f"Received event: {event}")
             if event['event'] == 'USER_CREATED':
+                if not AuthUser.query.filter_by(id=event['user_id']).first():
+                    new_user = AuthUser(
+                        id=event['user_id'],
+                        email=event['email'],
+                        password='SYNCED_USER',  # Placeholder for hashed password
+                        role=event['role'],
+                        branch_id=event['branch_id']
+                    )
+                    db.session.add(new_user)
+                    db.session.commit()
+                    logger.info(f"User {event['user_id']} synced to auth service")
+
+        def callback(ch, method, properties, body):
+            try:
                 with app.app_context():
-                    if not AuthUser.query.filter_by(id=event['user_id']).first():
-                        new_user = AuthUser(
-                            id=event['user_id'],
-                            email=event['email'],
-                            password='SYNCED_USER',  # Placeholder for hashed password
-                            role=event['role'],
-                            branch_id=event['branch_id']
-                        )
-                        db.session.add(new_user)
-                        db.session.commit()
-                        logger.info(f"User {event['user_id']} synced to auth service")
-
-        channel.basic_consume(queue='user_events', on_message_callback=callback, auto_ack=True)
+                    consumer.handle(body, properties, apply_event)
+            except Exception as e:
+                logger.error(f"Event processing error: {e}")
+
+        channel.basic_consume(queue='auth_service.user_events', on_message_callback=callback, auto_ack=True)
         logger.info("Waiting for user events...")
         channel.start_consuming()
     except pika.exceptions.AMQPConnectionError as e:
@@ -11,13 +11,20 @@ import uuid
 import requests
 from werkzeug.utils import secure_filename
 from auth_lib import requires_role, decode_token
+from messaging import IdempotentConsumer, Publisher, PublishError, parse_timestamp
 from threading import Lock
 import subprocess
+import re
+import hashlib
+from collections import OrderedDict
+from sqlalchemy import text
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+SERVICE_NAME = 'course_service'  # origin stamped on published events
+
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///course.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -32,6 +39,7 @@ NGINX_VOD_DIR = '/tmp/hls'  # Change to the appropriate folder where HLS files a
 
 
 class Course(db.Model):
+    __table_args__ = (db.Index('ix_course_branch_id', 'branch_id', 'id'),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     title = db.Column(db.String(120), nullable=False)
     description = db.Column(db.Text, nullable=False)
@@ -55,46 +63,403 @@ class Course(db.Model):
             "updated_at": self.updated_at.isoformat()
         }
 
+class OutboxEvent(db.Model):
+    """An event waiting to be relayed to RabbitMQ.
+
+    Rows are written in the same transaction as the course change they
+    describe and deleted once the broker has accepted them.
+    """
+    __tablename__ = 'outbox_events'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    queue = db.Column(db.String(120), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+# Response field name -> Course column, in the order serialize() emits them
+COURSE_FIELDS = {
+    "id": Course.id,
+    "title": Course.title,
+    "description": Course.description,
+    "teacher_id": Course.teacher_id,
+    "branch_id": Course.branch_id,
+    "hls_url": Course.hls_playlist,
+    "created_at": Course.created_at,
+    "updated_at": Course.updated_at
+}
+
+# Full-text index over course titles/descriptions. It is an external-content
+# FTS5 table that reads from `course`, and the triggers below keep it in sync
+# with every insert, update and delete made through the ORM or raw SQL.
+COURSE_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS course_fts USING fts5(
+        title, description,
+        content='course', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS course_fts_ai AFTER INSERT ON course BEGIN
+        INSERT INTO course_fts(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS course_fts_ad AFTER DELETE ON course BEGIN
+        INSERT INTO course_fts(course_fts, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS course_fts_au AFTER UPDATE OF title, description ON course BEGIN
+        INSERT INTO course_fts(course_fts, rowid, title, description)
+        VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO course_fts(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END""",
+]
+
+# Title matches weigh more than description matches in the BM25 rank
+SEARCH_TITLE_WEIGHT = 10.0
+SEARCH_DESCRIPTION_WEIGHT = 1.0
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+def init_course_search():
+    existing = db.session.execute(
+        text("SELECT name FROM sqlite_master WHERE type='table' AND name='course_fts'")
+    ).first()
+    for statement in COURSE_FTS_DDL:
+        db.session.execute(text(statement))
+    if not existing:
+        # Index courses created before the search table existed
+        db.session.execute(text("INSERT INTO course_fts(course_fts) VALUES ('rebuild')"))
+    db.session.commit()
+
+def build_match_query(raw_query):
+    # Quote every term so user input can never be parsed as FTS5 syntax,
+    # and let the last term match as a prefix for type-ahead.
+    terms = re.findall(r'\w+', raw_query, re.UNICODE)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
 with app.app_context():
     db.create_all()
+    # create_all() skips indexes on tables that already exist
+    for index in Course.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+    init_course_search()
 
 # RabbitMQ setup
-connection = None
-channel = None
-lock = Lock()
-
-def init_rabbitmq():
-    global connection, channel
-    with lock:
-        if not connection or connection.is_closed:
-            connection = pika.BlockingConnection(
-                pika.ConnectionParameters('rabbitmq')
-            )
-            channel = connection.channel()
-            channel.queue_declare(queue='user_interactions', durable=True)
-            channel.queue_declare(queue='course_events', durable=True)
+# Streams published to a fanout exchange of the same name, so every service
+# that needs them can bind its own queue. The queue of the same name stays
+# bound for the original consumer.
+FANOUT_EVENT_STREAMS = {'course_events'}
+
+publisher = Publisher(host='rabbitmq', origin=SERVICE_NAME)
+EVENT_ENVELOPES = os.getenv('EVENT_ENVELOPES', '1') != '0'
+for stream in FANOUT_EVENT_STREAMS:
+    publisher.declare_fanout(stream, [stream])
 
 def publish_message(queue, message):
     try:
-        init_rabbitmq()
-        with lock:
-            channel.basic_publish(
-                exchange='',
-                routing_key=queue,
-                body=json.dumps(message),
-                properties=pika.BasicProperties(
-                    delivery_mode=2  # Make messages persistent
-                )
-            )
+        publisher.publish(queue, message)
         logger.info(f"Published to {queue}: {message}")
-    except Exception as e:
+    except PublishError as e:
         logger.error(f"RabbitMQ error: {e}")
-        init_rabbitmq()
+
+def publish_messages(queue, messages):
+    # One pooled channel for the whole batch, packed into envelopes unless
+    # disabled for consumers that only understand one JSON event per message
+    try:
+        if EVENT_ENVELOPES:
+            publisher.publish_batch(queue, messages)
+        else:
+            publisher.publish_many(queue, messages)
+        logger.info(f"Published {len(messages)} messages to {queue}")
+        return True
+    except PublishError as e:
+        logger.error(f"RabbitMQ error: {e}")
+        return False
+
+# Transactional outbox
+OUTBOX_BATCH_SIZE = 100  # rows read and published per drain step
+OUTBOX_MAX_IN_FLIGHT = 1000  # published rows still awaiting a confirm
+OUTBOX_POLL_INTERVAL = 1  # seconds
+OUTBOX_MAX_BACKOFF = 60  # seconds
+
+def enqueue_event(queue, message):
+    # Added to the caller's session; it is committed (or rolled back) together
+    # with the course change and relayed asynchronously afterwards.
+    # Stamped now so every relay attempt publishes the same event id.
+    db.session.add(OutboxEvent(queue=queue, payload=json.dumps(publisher.stamp(message))))
+
+class OutboxRelay:
+    """Drains the outbox to RabbitMQ in id order with pipelined publisher confirms.
+
+    Rows are published without waiting for each confirm, up to
+    OUTBOX_MAX_IN_FLIGHT at a time, and deleted once the broker acks them;
+    one ack usually covers many rows. On a nack or a lost connection nothing
+    unconfirmed is deleted: the relay reconnects with exponential backoff and
+    republishes from the oldest remaining row, so events are delivered at
+    least once (consumers skip repeats by event_id) and never dropped.
+    """
+
+    def __init__(self, host):
+        self.parameters = pika.ConnectionParameters(host)
+        self.properties = pika.BasicProperties(delivery_mode=2)
+        self.connection = None
+        self.channel = None
+        self.backoff = 1
+
+    def run(self):
+        while True:
+            self.connection = None
+            try:
+                self.connection = pika.SelectConnection(
+                    self.parameters,
+                    on_open_callback=lambda connection: connection.channel(on_open_callback=self.on_channel_open),
+                    on_open_error_callback=self.on_connection_lost,
+                    on_close_callback=self.on_connection_lost
+                )
+                self.connection.ioloop.start()
+            except Exception as e:
+                logger.error(f"Outbox relay error: {e}")
+            connection, self.connection, self.channel = self.connection, None, None
+            if connection is not None:
+                connection.ioloop.close()
+            logger.error(f"Outbox relay disconnected. Retrying in {self.backoff}s")
+            time.sleep(self.backoff)
+            self.backoff = min(self.backoff * 2, OUTBOX_MAX_BACKOFF)
+
+    def wake(self):
+        """Drain now rather than at the next poll; safe from any thread."""
+        connection = self.connection
+        if connection is not None:
+            try:
+                connection.ioloop.add_callback_threadsafe(self.drain)
+            except Exception:
+                pass  # reconnecting; the next poll finds the rows
+
+    def on_connection_lost(self, connection, error):
+        logger.error(f"Outbox relay connection lost: {error}")
+        self.channel = None
+        connection.ioloop.stop()
+
+    def on_channel_open(self, channel):
+        self.channel = channel
+        self.declared = set()
+        self.declaring = set()
+        self.in_flight = OrderedDict()  # delivery tag -> outbox row id
+        self.last_tag = 0
+        self.after_id = 0  # newest row published on this channel
+        channel.add_on_close_callback(self.on_channel_closed)
+        channel.confirm_delivery(self.on_confirm, callback=lambda _: self.poll())
+
+    def on_channel_closed(self, channel, reason):
+        logger.error(f"Outbox relay channel closed: {reason}")
+        self.channel = None
+        if self.connection.is_open:
+            self.connection.close()
+
+    def poll(self):
+        # Picks up rows that no wake() announced, e.g. left by a crash
+        if self.channel is not None:
+            self.drain()
+            self.connection.ioloop.call_later(OUTBOX_POLL_INTERVAL, self.poll)
+
+    def declare(self, name):
+        """Declare where events for `name` go, then resume draining.
+
+        Each step waits for the broker's reply, so no event is published
+        before its queue is bound.
+        """
+        channel = self.channel
+        self.declaring.add(name)
+
+        def done(_):
+            self.declaring.discard(name)
+            self.declared.add(name)
+            self.drain()
+
+        if name in FANOUT_EVENT_STREAMS:
+            channel.exchange_declare(name, exchange_type='fanout', durable=True, callback=lambda _: channel.queue_declare(
+                name, durable=True, callback=lambda _: channel.queue_bind(name, name, callback=done)
+            ))
+        else:
+            channel.queue_declare(name, durable=True, callback=done)
+
+    def drain(self):
+        if self.channel is None or not self.channel.is_open:
+            return
+        room = min(OUTBOX_MAX_IN_FLIGHT - len(self.in_flight), OUTBOX_BATCH_SIZE)
+        if room <= 0:
+            return
+        with app.app_context():
+            rows = [(event.id, event.queue, event.payload) for event in OutboxEvent.query.filter(
+                OutboxEvent.id > self.after_id
+            ).order_by(OutboxEvent.id).limit(room)]
+        for row_id, queue, payload in rows:
+            if queue not in self.declared:
+                if queue not in self.declaring:
+                    self.declare(queue)
+                return
+            exchange, routing_key = (queue, '') if queue in FANOUT_EVENT_STREAMS else ('', queue)
+            self.channel.basic_publish(exchange, routing_key, payload, self.properties)
+            self.last_tag += 1
+            self.in_flight[self.last_tag] = row_id
+            self.after_id = row_id
+        if len(rows) == room:
+            # More may be waiting; continue once pending I/O and confirms ran
+            self.connection.ioloop.call_later(0, self.drain)
+
+    def on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            confirmed = []
+            while self.in_flight and next(iter(self.in_flight)) <= method.delivery_tag:
+                confirmed.append(self.in_flight.popitem(last=False)[1])
+        else:
+            confirmed = [self.in_flight.pop(method.delivery_tag)] if method.delivery_tag in self.in_flight else []
+        if isinstance(method, pika.spec.Basic.Nack):
+            # The rows stay; reconnecting republishes them
+            logger.error(f"Broker rejected {len(confirmed)} outbox events")
+            self.channel.close()
+            return
+        try:
+            with app.app_context():
+                OutboxEvent.query.filter(OutboxEvent.id.in_(confirmed)).delete(synchronize_session=False)
+                db.session.commit()
+        except Exception as e:
+            # Undeleted rows are published again, and skipped by event_id
+            logger.error(f"Deleting {len(confirmed)} relayed outbox events failed: {e}")
+            self.channel.close()
+            return
+        self.backoff = 1
+        logger.info(f"Relayed {len(confirmed)} outbox events")
+        self.drain()
+
+outbox_relay = OutboxRelay('rabbitmq')
+
+def notify_outbox():
+    outbox_relay.wake()
+
+# Course id -> branch id. A course never changes branch, so entries only
+# need to be dropped when the course is deleted.
+course_branch_cache = {}
+course_branch_lock = Lock()
+
+def get_course_branches(course_ids):
+    """Resolve branch ids for many courses with at most one query."""
+    course_ids = set(course_ids)
+    with course_branch_lock:
+        branches = {cid: course_branch_cache[cid] for cid in course_ids if cid in course_branch_cache}
+
+    missing = course_ids - branches.keys()
+    if missing:
+        rows = db.session.query(Course.id, Course.branch_id).filter(Course.id.in_(missing)).all()
+        found = {course_id: branch_id for course_id, branch_id in rows}
+        with course_branch_lock:
+            course_branch_cache.update(found)
+        branches.update(found)
+    return branches
+
+def forget_course_branch(course_id):
+    with course_branch_lock:
+        course_branch_cache.pop(course_id, None)
 
 # Helper functions
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
 
+def transcode_video(video):
+    """Save an uploaded video and transcode it to HLS; returns (filename, hls_url)."""
+    filename = secure_filename(video.filename)
+    video_path = os.path.join(NGINX_VOD_DIR, filename)
+    video.save(video_path)
+    output_dir = os.path.join('/tmp/hls', os.path.splitext(filename)[0])
+    os.makedirs(output_dir, exist_ok=True)
+
+    ffmpeg_command = [
+        'ffmpeg',
+        '-i', video_path,
+        '-profile:v', 'baseline',
+        '-level', '3.0',
+        '-s', '640x360',
+        '-start_number', '0',
+        '-hls_time', '10',
+        '-hls_list_size', '0',
+        '-f', 'hls',
+        f'{output_dir}/index.m3u8'
+    ]
+
+    subprocess.run(ffmpeg_command, check=True)
+    return filename, f"{NGINX_RTMP_URL}/{os.path.splitext(filename)[0]}/index.m3u8"
+
+LIST_MAX_LIMIT = 500
+
+def parse_list_params():
+    """Read the `fields`, `limit` and `cursor` query args shared by course listings.
+
+    Raises ValueError with a client-facing message on bad input.
+    """
+    fields = list(COURSE_FIELDS)
+    if request.args.get('fields'):
+        requested = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+        unknown = [f for f in requested if f not in COURSE_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+        # The id is always returned since it doubles as the pagination cursor
+        fields = [f for f in COURSE_FIELDS if f == 'id' or f in requested]
+
+    limit = request.args.get('limit')
+    if limit is not None:
+        if not limit.isdigit() or not 1 <= int(limit) <= LIST_MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {LIST_MAX_LIMIT}")
+        limit = int(limit)
+
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        if not cursor.isdigit():
+            raise ValueError("Invalid cursor")
+        cursor = int(cursor)
+
+    return fields, limit, cursor
+
+def course_list_response(query):
+    """Run a course listing with keyset pagination and column projection.
+
+    Only the requested columns are selected, so unrequested ones (typically
+    `description`) are never loaded. The body stays a plain list; when a page
+    is full the cursor for the next page is sent in the `X-Next-Cursor` header.
+    """
+    try:
+        fields, limit, cursor = parse_list_params()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    query = query.with_entities(*[COURSE_FIELDS[f] for f in fields]).order_by(Course.id)
+    if cursor is not None:
+        query = query.filter(Course.id > cursor)
+    if limit is not None:
+        query = query.limit(limit + 1)
+
+    rows = query.all()
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+
+    courses = []
+    for row in rows:
+        course = dict(zip(fields, row))
+        for key in ('created_at', 'updated_at'):
+            if course.get(key) is not None:
+                course[key] = course[key].isoformat()
+        courses.append(course)
+
+    response = jsonify(courses)
+    if next_cursor is not None:
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+    return response, 200
+
 # Course Endpoints
 @app.route('/courses', methods=['POST'])
 @requires_role(['teacher', 'admin'])
@@ -113,28 +478,7 @@ def create_course():
         if not all([title, description, teacher_id, branch_id]) or not video:
             return jsonify({"error": "All fields are required"}), 400
 
-        # Save video to MistServer VOD directory
-        filename = secure_filename(video.filename)
-        video_path = os.path.join(NGINX_VOD_DIR, filename)
-        video.save(video_path)
-        output_dir = os.path.join('/tmp/hls', os.path.splitext(filename)[0])
-        os.makedirs(output_dir, exist_ok=True)
-
-        ffmpeg_command = [
-            'ffmpeg',
-            '-i', video_path,
-            '-profile:v', 'baseline',
-            '-level', '3.0',
-            '-s', '640x360',
-            '-start_number', '0',
-            '-hls_time', '10',
-            '-hls_list_size', '0',
-            '-f', 'hls',
-            f'{output_dir}/index.m3u8'
-        ]
-
-        subprocess.run(ffmpeg_command, check=True)
-        hls_url = f"{NGINX_RTMP_URL}/{os.path.splitext(filename)[0]}/index.m3u8"
+        filename, hls_url = transcode_video(video)
 
         new_course = Course(
             title=title,
@@ -145,9 +489,9 @@ def create_course():
             hls_playlist=hls_url  # Store full URL
         )
         db.session.add(new_course)
-        db.session.commit()
+        db.session.flush()
 
-        publish_message('course_events', {
+        enqueue_event('course_events', {
             "event": "COURSE_CREATED",
             "course_id": new_course.id,
             "title": new_course.title,
@@ -156,10 +500,13 @@ def create_course():
             "branch_id": branch_id,
             "hls_url": hls_url
         })
+        db.session.commit()
+        notify_outbox()
 
         return jsonify(new_course.serialize()), 201
 
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Course creation failed: {e}")
         return jsonify({"error": "Internal server error"}), 500
 @app.route('/courses', methods=['GET'])
@@ -178,12 +525,80 @@ def get_courses():
             if user['role'] in ['admin']:
                 query = query.filter_by(branch_id=request.args.get('branch_id'))
         
-        courses = query.all()
-        return jsonify([c.serialize() for c in courses]), 200
+        return course_list_response(query)
     except Exception as e:
         logger.error(f"Failed to fetch courses: {e}")
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route('/courses/search', methods=['GET'])
+@requires_role(['student', 'teacher', 'admin'])
+def search_courses():
+    try:
+        user = g.user
+        match_query = build_match_query(request.args.get('q', ''))
+        if not match_query:
+            return jsonify({"error": "Search query is required"}), 400
+
+        try:
+            limit = min(int(request.args.get('limit', SEARCH_DEFAULT_LIMIT)), SEARCH_MAX_LIMIT)
+            offset = int(request.args.get('offset', 0))
+        except ValueError:
+            return jsonify({"error": "limit and offset must be integers"}), 400
+        if limit < 1 or offset < 0:
+            return jsonify({"error": "Invalid pagination parameters"}), 400
+
+        # Same branch scoping as GET /courses
+        branch_id = None
+        if user['role'] in ['student', 'teacher']:
+            branch_id = user['branch_id']
+        elif 'branch_id' in request.args:
+            branch_id = request.args.get('branch_id', type=int)
+
+        sql = """
+            SELECT course_fts.rowid AS id,
+                   bm25(course_fts, :title_weight, :description_weight) AS score,
+                   snippet(course_fts, 1, '<b>', '</b>', '…', 12) AS snippet
+            FROM course_fts
+            JOIN course ON course.id = course_fts.rowid
+            WHERE course_fts MATCH :match
+        """
+        params = {
+            "match": match_query,
+            "title_weight": SEARCH_TITLE_WEIGHT,
+            "description_weight": SEARCH_DESCRIPTION_WEIGHT,
+            "limit": limit + 1,
+            "offset": offset
+        }
+        if branch_id is not None:
+            sql += " AND course.branch_id = :branch_id"
+            params["branch_id"] = branch_id
+        sql += " ORDER BY score LIMIT :limit OFFSET :offset"
+
+        hits = db.session.execute(text(sql), params).fetchall()
+        has_more = len(hits) > limit
+        hits = hits[:limit]
+
+        courses = {c.id: c for c in Course.query.filter(Course.id.in_([h.id for h in hits]))}
+        results = []
+        for hit in hits:
+            course = courses.get(hit.id)
+            if course:
+                result = course.serialize()
+                # bm25() is lower-is-better; expose a higher-is-better score
+                result["score"] = -hit.score
+                result["snippet"] = hit.snippet
+                results.append(result)
+
+        return jsonify({
+            "results": results,
+            "limit": limit,
+            "offset": offset,
+            "next_offset": offset + limit if has_more else None
+        }), 200
+    except Exception as e:
+        logger.error(f"Course search failed: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
 @app.route('/courses/<int:course_id>', methods=['GET'])
 @requires_role(['student', 'teacher', 'admin'])
 def get_course(course_id):
@@ -199,7 +614,7 @@ def get_course(course_id):
         logger.error(f"Failed to fetch course: {e}")
         return jsonify({"error": "Internal server error"}), 500
 
-app.route('/courses/<int:course_id>', methods=['PUT'])
+@app.route('/courses/<int:course_id>', methods=['PUT'])
 @requires_role(['teacher', 'admin'])
 def update_course(course_id):
     try:
@@ -215,18 +630,12 @@ def update_course(course_id):
         if 'description' in data:
             course.description = data['description']
         if 'video' in request.files:
-            video = request.files['video']
-            filename = secure_filename(video.filename)
-            video_path = os.path.join(MIST_VOD_DIR, filename)
-            video.save(video_path)
-            hls_url = f"/vod/{filename}/index.m3u8"  # Instead of MIST_SERVER_URL
+            # Same HLS pipeline as create, so the stored URL is playable
+            course.video_filename, course.hls_playlist = transcode_video(request.files['video'])
 
-            course.hls_playlist = hls_url
-            course.video_filename = filename
+        db.session.flush()
 
-        db.session.commit()
-
-        publish_message('course_events', {
+        enqueue_event('course_events', {
             "event": "COURSE_UPDATED",
             "course_id": course.id,
             "title": course.title,
@@ -234,9 +643,12 @@ def update_course(course_id):
             "hls_url": course.hls_playlist,
             "branch_id": course.branch_id
         })
+        db.session.commit()
+        notify_outbox()
 
         return jsonify(course.serialize()), 200
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Course update failed: {e}")
         return jsonify({"error": "Internal server error"}), 500
     
@@ -253,16 +665,18 @@ def delete_course(course_id):
 
         course_data = course.serialize()
         db.session.delete(course)
-        db.session.commit()
-
-        publish_message('course_events', {
+        enqueue_event('course_events', {
             "event": "COURSE_DELETED",
             "course_id": course_id,
             "branch_id": course_data['branch_id']
         })
+        db.session.commit()
+        forget_course_branch(course_id)
+        notify_outbox()
 
         return jsonify({"message": "Course deleted successfully"}), 200
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Course deletion failed: {e}")
         return jsonify({"error": "Internal server error"}), 500
 
@@ -278,7 +692,7 @@ def get_teacher_courses(teacher_id):
         elif user['role'] == 'teacher':
             courses = courses.filter_by(branch_id=user['branch_id'])
             
-        return jsonify([c.serialize() for c in courses]), 200
+        return course_list_response(courses)
     except Exception as e:
         logger.error(f"Failed to fetch teacher courses: {e}")
         return jsonify({"error": "Internal server error"}), 500
@@ -292,7 +706,7 @@ def get_branch_courses(branch_id):
             return jsonify({"error": "Unauthorized branch access"}), 403
 
         courses = Course.query.filter_by(branch_id=branch_id)
-        return jsonify([c.serialize() for c in courses]), 200
+        return course_list_response(courses)
     except Exception as e:
         logger.error(f"Failed to fetch branch courses: {e}")
         return jsonify({"error": "Internal server error"}), 500
@@ -302,20 +716,70 @@ def get_course_branch(course_id):
     course = Course.query.get_or_404(course_id)
     return jsonify({"course_id": course_id, "branch_id": course.branch_id}), 200
 
+BULK_BRANCH_MAX_IDS = 1000
+
+@app.route('/courses/branches', methods=['GET'])
+def get_course_branches_bulk():
+    """Map many course ids to branch ids: GET /courses/branches?ids=1,2,3"""
+    try:
+        course_ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({"error": "ids must be a comma-separated list of integers"}), 400
+    if not course_ids:
+        return jsonify({"error": "ids is required"}), 400
+    if len(course_ids) > BULK_BRANCH_MAX_IDS:
+        return jsonify({"error": f"At most {BULK_BRANCH_MAX_IDS} ids per request"}), 400
+
+    try:
+        branches = get_course_branches(course_ids)
+        return jsonify({
+            "branches": {str(cid): bid for cid, bid in branches.items()},
+            "missing": sorted(set(course_ids) - branches.keys())
+        }), 200
+    except Exception as e:
+        logger.error(f"Bulk branch lookup failed: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
+@app.route('/branches/<int:branch_id>/course-ids', methods=['GET'])
+def get_branch_course_ids(branch_id):
+    """List only the course ids of a branch, with a version stamp.
+
+    The version changes exactly when the set of ids changes. It is also sent
+    as the ETag, so callers can revalidate with If-None-Match and get a 304
+    instead of the list when nothing changed.
+    """
+    try:
+        course_ids = [row[0] for row in db.session.query(Course.id).filter(
+            Course.branch_id == branch_id
+        ).order_by(Course.id)]
+        version = hashlib.sha1(','.join(map(str, course_ids)).encode()).hexdigest()[:16]
+
+        if version in request.if_none_match:
+            response = app.response_class(status=304)
+        else:
+            response = jsonify({"branch_id": branch_id, "version": version, "course_ids": course_ids})
+        response.set_etag(version)
+        return response
+    except Exception as e:
+        logger.error(f"Failed to list branch course ids: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
 @app.route('/courses/<int:course_id>/view', methods=['POST'])
 @requires_role(['student'])
 def track_course_view(course_id):
     try:
         user = g.user
-        course = Course.query.get_or_404(course_id)
+        branch_id = get_course_branches([course_id]).get(course_id)
+        if branch_id is None:
+            return jsonify({"error": "Resource not found"}), 404
         
-        if course.branch_id != user['branch_id']:
+        if branch_id != user['branch_id']:
             return jsonify({"error": "Course not available in your branch"}), 403
 
         publish_message('user_interactions', {
             "event": "COURSE_VIEWED",
             "course_id": course_id,
-            "branch_id": course.branch_id,
+            "branch_id": branch_id,
             "student_id": user['user_id'],
             "timestamp": datetime.now(timezone.utc).isoformat()
         })
@@ -324,25 +788,99 @@ def track_course_view(course_id):
         logger.error(f"View tracking failed: {e}")
         return jsonify({"error": "Internal server error"}), 500
 
+VIEW_BATCH_MAX_SIZE = 500
+
+@app.route('/courses/views/batch', methods=['POST'])
+@requires_role(['student'])
+def track_course_views_batch():
+    """Accept many views at once so players can flush every few seconds.
+
+    Body: {"views": [{"course_id": 1, "timestamp": "<iso8601, optional>"}, ...]}
+    Valid views are published; invalid ones are reported back by index.
+    """
+    try:
+        user = g.user
+        data = request.get_json(silent=True) or {}
+        views = data.get('views')
+        if not isinstance(views, list) or not views:
+            return jsonify({"error": "A non-empty views list is required"}), 400
+        if len(views) > VIEW_BATCH_MAX_SIZE:
+            return jsonify({"error": f"At most {VIEW_BATCH_MAX_SIZE} views per batch"}), 400
+
+        now = datetime.now(timezone.utc)
+        parsed, rejected = [], []
+        for index, view in enumerate(views):
+            course_id = view.get('course_id') if isinstance(view, dict) else None
+            if not isinstance(course_id, int) or isinstance(course_id, bool):
+                rejected.append({"index": index, "error": "Invalid course_id"})
+                continue
+            timestamp = now
+            if view.get('timestamp'):
+                try:
+                    timestamp = parse_timestamp(view['timestamp'])
+                except (TypeError, ValueError):
+                    rejected.append({"index": index, "error": "Invalid timestamp"})
+                    continue
+                if timestamp.tzinfo is None:
+                    timestamp = timestamp.replace(tzinfo=timezone.utc)
+                timestamp = min(timestamp, now)
+            parsed.append((index, course_id, timestamp))
+
+        branches = get_course_branches(course_id for _, course_id, _ in parsed)
+        events = []
+        for index, course_id, timestamp in parsed:
+            branch_id = branches.get(course_id)
+            if branch_id is None:
+                rejected.append({"index": index, "error": "Course not found"})
+            elif branch_id != user['branch_id']:
+                rejected.append({"index": index, "error": "Course not available in your branch"})
+            else:
+                events.append({
+                    "event": "COURSE_VIEWED",
+                    "course_id": course_id,
+                    "branch_id": branch_id,
+                    "student_id": user['user_id'],
+                    "timestamp": timestamp.isoformat()
+                })
+
+        if events and not publish_messages('user_interactions', events):
+            return jsonify({"error": "Failed to record views"}), 503
+
+        rejected.sort(key=lambda r: r['index'])
+        return jsonify({"accepted": len(events), "rejected": rejected}), 200
+    except Exception as e:
+        logger.error(f"Batch view tracking failed: {e}")
+        return jsonify({"error": "Internal server error"}), 500
+
 # RabbitMQ Consumer
+# Everything on course_events is published here; only foreign events are logged
+consumer = IdempotentConsumer(SERVICE_NAME)
+
 def consume_course_events():
     while True:
         try:
             connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
             channel = connection.channel()
-            channel.queue_declare(queue='course_events', durable=True)
+            # A private queue on the fanout exchange, so this listener no
+            # longer takes events away from playlist_service
+            channel.exchange_declare(exchange='course_events', exchange_type='fanout', durable=True)
+            queue = channel.queue_declare(queue='', exclusive=True).method.queue
+            channel.queue_bind(queue=queue, exchange='course_events')
 
             def callback(ch, method, properties, body):
-                event = json.loads(body)
-                logger.info(f"Processing event: {event['event']}")
+                try:
+                    consumer.handle(body, properties, lambda event: logger.info(f"Processing event: {event['event']}"))
+                except Exception as e:
+                    logger.error(f"Event processing error: {e}")
 
-            channel.basic_consume(queue='course_events', on_message_callback=callback, auto_ack=True)
+            channel.basic_consume(queue=queue, on_message_callback=callback, auto_ack=True)
             channel.start_consuming()
         except Exception as e:
             logger.error(f"RabbitMQ connection error: {e}")
             time.sleep(5)
 
 threading.Thread(target=consume_course_events, daemon=True).start()
+threading.Thread(target=outbox_relay.run, daemon=True).start()
 
 if __name__ == '__main__':
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
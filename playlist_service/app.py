@@ -3,15 +3,24 @@ from flask import Flask, jsonify, request, g
 from flask_sqlalchemy import SQLAlchemy
 import pika
 import threading
-import json
 import logging
 import time
+import requests
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+from sqlalchemy import text, bindparam
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from auth_lib import requires_role, decode_token
+from messaging import DedupeStore, IdempotentConsumer, Publisher, PublishError, decode_events, encode_event, is_envelope, parse_timestamp
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+SERVICE_NAME = 'playlist_service'  # origin stamped on published events
+
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///playlist.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -20,18 +29,28 @@ db = SQLAlchemy(app)
 # Database Models
 class Playlist(db.Model):
     __tablename__ = 'playlists'
+    __table_args__ = (db.Index('ix_playlists_branch_public', 'branch_id', 'is_public'),)
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name = db.Column(db.String(120), nullable=False)
     student_id = db.Column(db.Integer, nullable=False)
     branch_id = db.Column(db.Integer, nullable=False)
     is_public = db.Column(db.Boolean, default=True)
+    # Denormalized len(courses), maintained by the add/remove endpoints and
+    # COURSE_DELETED events so listings never have to load associations
+    course_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     courses = db.relationship('PlaylistCourse', backref='playlist', cascade='all, delete-orphan')
 
 class PlaylistCourse(db.Model):
     __tablename__ = 'playlist_courses'
+    __table_args__ = (
+        db.Index('ix_playlist_courses_playlist', 'playlist_id', 'course_id'),
+        db.Index('ix_playlist_courses_course', 'course_id'),
+    )
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     playlist_id = db.Column(db.Integer, db.ForeignKey('playlists.id'), nullable=False)
     course_id = db.Column(db.Integer, db.ForeignKey('courses.id'), nullable=False)
+    # 0-based, dense within a playlist
+    position = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
 class Course(db.Model):
     __tablename__ = 'courses'
@@ -41,83 +60,241 @@ class Course(db.Model):
     video_url = db.Column(db.String(255), nullable=False)
     branch_id = db.Column(db.Integer, nullable=False)
 
+def ensure_column(table, column, ddl):
+    # create_all() never alters existing tables, so add new columns by hand
+    columns = [row[1] for row in db.session.execute(text(f"PRAGMA table_info({table})"))]
+    if column in columns:
+        return False
+    db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    return True
+
 # Initialize database
 with app.app_context():
     db.create_all()
+    for model in (Playlist, PlaylistCourse):
+        for index in model.__table__.indexes:
+            index.create(db.engine, checkfirst=True)
+    if ensure_column('playlists', 'course_count', 'INTEGER NOT NULL DEFAULT 0'):
+        db.session.execute(text(
+            "UPDATE playlists SET course_count = "
+            "(SELECT COUNT(*) FROM playlist_courses WHERE playlist_courses.playlist_id = playlists.id)"
+        ))
+    if ensure_column('playlist_courses', 'position', 'INTEGER NOT NULL DEFAULT 0'):
+        # Existing entries keep their insertion order
+        db.session.execute(text(
+            "UPDATE playlist_courses SET position = "
+            "(SELECT COUNT(*) FROM playlist_courses AS earlier "
+            " WHERE earlier.playlist_id = playlist_courses.playlist_id "
+            " AND earlier.id < playlist_courses.id)"
+        ))
+    db.session.commit()
+    consumer = IdempotentConsumer(SERVICE_NAME, DedupeStore(db.engine))
 
 # RabbitMQ Configuration
 RABBITMQ_HOST = 'rabbitmq'
+publisher = Publisher(host=RABBITMQ_HOST, origin=SERVICE_NAME)
 
 def publish_message(queue, message):
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
-        channel = connection.channel()
-        channel.queue_declare(queue=queue, durable=True)
+        publisher.publish(queue, message)
+        logger.info(f"Published to {queue}: {message}")
+    except PublishError as e:
+        logger.error(f"Failed to publish message: {e}")
+
+# Course replica consumer
+COURSE_EVENTS_QUEUE = 'course_events'
+COURSE_EVENTS_DLQ = 'course_events.dlq'
+COURSE_EVENT_BATCH_SIZE = 500
+COURSE_EVENT_FLUSH_INTERVAL = 0.5  # seconds
+COURSE_EVENT_PREFETCH = COURSE_EVENT_BATCH_SIZE * 2
+COURSE_EVENT_RETRY_DELAY = 5  # seconds before a requeued batch comes back
+
+def required_text(event, field):
+    value = event[field]
+    if not isinstance(value, str) or not value:
+        raise ValueError(f"{field} must be a non-empty string")
+    return value
+
+def parse_course_event(event):
+    """Turn a decoded course event into (course_id, event, row).
+
+    Returns None for event types the replica ignores and raises ValueError
+    for events that can never be applied.
+    """
+    try:
+        course_id = int(event['course_id'])
+        if event['event'] in ('COURSE_CREATED', 'COURSE_UPDATED'):
+            return course_id, event['event'], {
+                "id": course_id,
+                "title": required_text(event, 'title'),
+                "description": str(event.get('description') or ''),
+                "video_url": required_text(event, 'hls_url'),
+                "branch_id": int(event['branch_id'])
+            }
+        if event['event'] == 'COURSE_DELETED':
+            return course_id, event['event'], None
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f"Malformed course event: {e}")
+    logger.info(f"Ignoring {event['event']} event")
+    return None
+
+def apply_course_events(parsed, processed=()):
+    """Apply parsed (course_id, event, row) tuples in one transaction.
+
+    Events are collapsed to the last one per course id: creates/updates
+    become a single INSERT ... ON CONFLICT upsert and deletes a bulk DELETE.
+    The ids of the decoded `processed` events commit in the same
+    transaction, so a redelivery after a crash is skipped.
+    """
+    latest = {}
+    deleted_ids = set()
+    for course_id, event, row in parsed:
+        latest[course_id] = row
+        if event == 'COURSE_DELETED':
+            deleted_ids.add(course_id)
+
+    upserts = [row for row in latest.values() if row is not None]
+    removed = [course_id for course_id, row in latest.items() if row is None]
+
+    with app.app_context():
+        try:
+            if upserts:
+                stmt = sqlite_insert(Course).values(upserts)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[Course.id],
+                    set_={column: stmt.excluded[column] for column in ('title', 'description', 'video_url', 'branch_id')}
+                )
+                db.session.execute(stmt)
+
+            # Any course deleted in this batch loses its playlist entries,
+            # even if it was re-created by a later event
+            if deleted_ids:
+                affected = [playlist_id for (playlist_id,) in db.session.query(
+                    PlaylistCourse.playlist_id
+                ).filter(PlaylistCourse.course_id.in_(deleted_ids)).distinct()]
+                PlaylistCourse.query.filter(
+                    PlaylistCourse.course_id.in_(deleted_ids)
+                ).delete(synchronize_session=False)
+                if affected:
+                    params = {"playlist_ids": affected}
+                    # Renumber positions densely and recount the affected playlists
+                    db.session.execute(text(
+                        "UPDATE playlist_courses SET position = "
+                        "(SELECT COUNT(*) FROM playlist_courses AS earlier "
+                        " WHERE earlier.playlist_id = playlist_courses.playlist_id "
+                        " AND (earlier.position < playlist_courses.position "
+                        "  OR (earlier.position = playlist_courses.position AND earlier.id < playlist_courses.id))) "
+                        "WHERE playlist_id IN :playlist_ids"
+                    ).bindparams(bindparam('playlist_ids', expanding=True)), params)
+                    db.session.execute(text(
+                        "UPDATE playlists SET course_count = "
+                        "(SELECT COUNT(*) FROM playlist_courses WHERE playlist_courses.playlist_id = playlists.id) "
+                        "WHERE id IN :playlist_ids"
+                    ).bindparams(bindparam('playlist_ids', expanding=True)), params)
+
+            if removed:
+                Course.query.filter(Course.id.in_(removed)).delete(synchronize_session=False)
+
+            consumer.processed(processed, db.session)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    logger.info(f"Applied {len(parsed)} course events ({len(upserts)} upserts, {len(removed)} deletes)")
+
+def requeue_course_batch(channel, messages, error):
+    """Hand a whole batch back to the broker after a failure the events did
+    not cause. Events already committed are skipped on redelivery."""
+    logger.error(f"Course batch requeued: {error}")
+    channel.basic_nack(delivery_tag=messages[-1][0].delivery_tag, multiple=True, requeue=True)
+    # Keeps I/O running, so the connection survives the pause
+    channel.connection.sleep(COURSE_EVENT_RETRY_DELAY)
+
+def process_course_batch(channel, messages):
+    """Apply (method, properties, body) triples and ack them all at once.
+
+    Only undecodable messages and malformed events go straight to the
+    dead-letter queue. A database error such as a locked or full database
+    says nothing about the events, so the batch is requeued and nothing is
+    dead-lettered. Any other batch failure is retried event by event; an
+    event that still fails requeues the batch once, in case the failure was
+    transient, and is dead-lettered when it fails again on redelivery.
+    """
+    decoded, poison = [], []
+    for method, properties, body in messages:
+        try:
+            events = decode_events(body, properties)
+        except ValueError as e:
+            logger.error(f"Undecodable course message: {e}")
+            poison.append(body)
+            continue
+        enveloped = is_envelope(properties)
+        decoded += [(encode_event(event) if enveloped else body, event, method.redelivered) for event in events]
+
+    # Redelivered events are dropped before they reach the database
+    parsed = []
+    for raw, event, redelivered in consumer.fresh(decoded, key=lambda item: item[1]):
+        try:
+            course = parse_course_event(event)
+        except ValueError as e:
+            logger.error(str(e))
+            poison.append(raw)
+            continue
+        if course:
+            parsed.append((raw, event, course, redelivered))
+
+    try:
+        apply_course_events([course for _, _, course, _ in parsed], [event for _, event, _, _ in parsed])
+    except OperationalError as e:
+        requeue_course_batch(channel, messages, e)
+        return
+    except Exception as e:
+        logger.error(f"Course batch failed, retrying individually: {e}")
+        for raw, event, course, redelivered in parsed:
+            try:
+                apply_course_events([course], [event])
+            except Exception as e:
+                if isinstance(e, OperationalError) or not redelivered:
+                    requeue_course_batch(channel, messages, e)
+                    return
+                logger.error(f"Course event processing failed again: {e}")
+                poison.append(raw)
+
+    for body in poison:
         channel.basic_publish(
             exchange='',
-            routing_key=queue,
-            body=json.dumps(message),
+            routing_key=COURSE_EVENTS_DLQ,
+            body=body,
             properties=pika.BasicProperties(delivery_mode=2)
         )
-        connection.close()
-        logger.info(f"Published to {queue}: {message}")
-    except Exception as e:
-        logger.error(f"Failed to publish message: {e}")
+    channel.basic_ack(delivery_tag=messages[-1][0].delivery_tag, multiple=True)
 
 def consume_course_events():
     while True:
         try:
             connection = pika.BlockingConnection(pika.ConnectionParameters(RABBITMQ_HOST))
             channel = connection.channel()
-            channel.queue_declare(queue='course_events', durable=True)
-
-            def callback(ch, method, properties, body):
-                try:
-                    event = json.loads(body)
-                    logger.info(f"Processing {event['event']} event")
-                    
-                    with app.app_context():
-                        if event['event'] == 'COURSE_CREATED':
-                            existing_course = Course.query.get(event['course_id'])
-                            if existing_course:
-                                existing_course.title = event['title']
-                                existing_course.description = event.get('description', '')
-                                existing_course.video_url = event['hls_url']
-                                existing_course.branch_id = event['branch_id']
-                            else:
-                                new_course = Course(
-                                    id=event['course_id'],
-                                    title=event['title'],
-                                    description=event.get('description', ''),
-                                    video_url=event['hls_url'],
-                                    branch_id=event['branch_id']
-                                )
-                                db.session.add(new_course)
-                            db.session.commit()
-
-                        elif event['event'] == 'COURSE_UPDATED':
-                            course = Course.query.get(event['course_id'])
-                            if course:
-                                course.title = event['title']
-                                course.description = event.get('description', '')
-                                course.video_url = event['hls_url']
-                                course.branch_id = event['branch_id']
-                                db.session.commit()
-
-                        elif event['event'] == 'COURSE_DELETED':
-                            # Delete all playlist associations first
-                            PlaylistCourse.query.filter_by(course_id=event['course_id']).delete()
-                            # Delete the course itself
-                            Course.query.filter_by(id=event['course_id']).delete()
-                            db.session.commit()
-
-                except Exception as e:
-                    logger.error(f"Event processing error: {str(e)}")
-                finally:
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
-
-            channel.basic_consume(queue='course_events', on_message_callback=callback, auto_ack=False)
-            channel.start_consuming()
+            channel.exchange_declare(exchange=COURSE_EVENTS_QUEUE, exchange_type='fanout', durable=True)
+            channel.queue_declare(queue=COURSE_EVENTS_QUEUE, durable=True)
+            channel.queue_bind(queue=COURSE_EVENTS_QUEUE, exchange=COURSE_EVENTS_QUEUE)
+            channel.queue_declare(queue=COURSE_EVENTS_DLQ, durable=True)
+            channel.basic_qos(prefetch_count=COURSE_EVENT_PREFETCH)
+
+            messages = []
+            deadline = None
+            for method, properties, body in channel.consume(
+                COURSE_EVENTS_QUEUE, inactivity_timeout=COURSE_EVENT_FLUSH_INTERVAL
+            ):
+                if method is not None:
+                    messages.append((method, properties, body))
+                    if deadline is None:
+                        deadline = time.monotonic() + COURSE_EVENT_FLUSH_INTERVAL
+                    if len(messages) < COURSE_EVENT_BATCH_SIZE and time.monotonic() < deadline:
+                        continue
+                if messages:
+                    process_course_batch(channel, messages)
+                    messages = []
+                    deadline = None
         except Exception as e:
             logger.error(f"RabbitMQ connection error: {str(e)}")
             time.sleep(5)
@@ -173,8 +350,13 @@ def add_course_to_playlist(playlist_id):
         ).first():
             return jsonify({"error": "Course already in playlist"}), 400
 
-        association = PlaylistCourse(playlist_id=playlist_id, course_id=course_id)
+        association = PlaylistCourse(
+            playlist_id=playlist_id,
+            course_id=course_id,
+            position=playlist.course_count
+        )
         db.session.add(association)
+        playlist.course_count = Playlist.course_count + 1
         db.session.commit()
 
         publish_message('user_interactions', {
@@ -208,6 +390,11 @@ def remove_course_from_playlist(playlist_id, course_id):
         ).first_or_404()
 
         db.session.delete(association)
+        PlaylistCourse.query.filter(
+            PlaylistCourse.playlist_id == playlist_id,
+            PlaylistCourse.position > association.position
+        ).update({PlaylistCourse.position: PlaylistCourse.position - 1}, synchronize_session=False)
+        playlist.course_count = Playlist.course_count - 1
         db.session.commit()
 
         publish_message('user_interactions', {
@@ -226,6 +413,132 @@ def remove_course_from_playlist(playlist_id, course_id):
         logger.error(f"Course removal error: {str(e)}")
         return jsonify({"error": "Failed to remove course"}), 500
 
+MAX_PLAYLIST_OPERATIONS = 200
+
+def validate_playlist_operation(operation):
+    """Check one operation's shape; returns an error message or None."""
+    if not isinstance(operation, dict):
+        return "Invalid operation"
+    course_id = operation.get('course_id')
+    position = operation.get('position')
+    if not isinstance(course_id, int) or isinstance(course_id, bool):
+        return "Invalid course_id"
+    if position is not None and (not isinstance(position, int) or isinstance(position, bool) or position < 0):
+        return "Invalid position"
+    return None
+
+def apply_playlist_operation(order, operation, available):
+    """Apply one validated add/remove/move to the in-memory course order.
+
+    Returns an error message, or None when the operation was applied.
+    """
+    action = operation.get('op')
+    course_id = operation.get('course_id')
+    position = operation.get('position')
+
+    if action == 'add':
+        if course_id in order:
+            return "Course already in playlist"
+        if course_id not in available:
+            return "Course not found"
+        order.insert(len(order) if position is None else position, course_id)
+    elif action == 'remove':
+        if course_id not in order:
+            return "Course not in playlist"
+        order.remove(course_id)
+    elif action == 'move':
+        if course_id not in order:
+            return "Course not in playlist"
+        if position is None:
+            return "Position required for move"
+        order.remove(course_id)
+        order.insert(position, course_id)
+    else:
+        return "Unknown op"
+    return None
+
+@app.route('/playlists/<int:playlist_id>/courses', methods=['PATCH'])
+@requires_role(['student'])
+def update_playlist_courses(playlist_id):
+    """Apply a batch of course operations in one transaction.
+
+    Body: {"operations": [{"op": "add", "course_id": 1, "position": 0},
+                          {"op": "remove", "course_id": 2},
+                          {"op": "move", "course_id": 3, "position": 1}]}
+    Operations run in order; if any of them is invalid nothing is applied.
+    """
+    data = request.get_json(silent=True) or {}
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"error": "Operations required"}), 400
+    if len(operations) > MAX_PLAYLIST_OPERATIONS:
+        return jsonify({"error": f"At most {MAX_PLAYLIST_OPERATIONS} operations per request"}), 400
+    invalid = [
+        {"index": index, "error": error}
+        for index, error in enumerate(map(validate_playlist_operation, operations)) if error
+    ]
+    if invalid:
+        return jsonify({"error": "Invalid operations", "operations": invalid}), 400
+
+    try:
+        playlist = Playlist.query.filter_by(
+            id=playlist_id,
+            student_id=g.user['user_id']
+        ).first_or_404()
+
+        entries = PlaylistCourse.query.filter_by(playlist_id=playlist_id).order_by(
+            PlaylistCourse.position, PlaylistCourse.id
+        ).all()
+        by_course = {entry.course_id: entry for entry in entries}
+        order = [entry.course_id for entry in entries]
+
+        add_ids = {op['course_id'] for op in operations if op.get('op') == 'add'}
+        available = set()
+        if add_ids:
+            available = {course_id for (course_id,) in db.session.query(Course.id).filter(
+                Course.id.in_(add_ids),
+                Course.branch_id == g.user['branch_id']
+            )}
+
+        for index, operation in enumerate(operations):
+            error = apply_playlist_operation(order, operation, available)
+            if error:
+                return jsonify({"error": error, "index": index}), 400
+
+        # Write the net difference between the old and the new order
+        kept = set(order)
+        removed = [course_id for course_id in by_course if course_id not in kept]
+        added = []
+        for course_id in removed:
+            db.session.delete(by_course[course_id])
+        for position, course_id in enumerate(order):
+            entry = by_course.get(course_id)
+            if entry is None:
+                db.session.add(PlaylistCourse(playlist_id=playlist_id, course_id=course_id, position=position))
+                added.append(course_id)
+            elif entry.position != position:
+                entry.position = position
+        playlist.course_count = len(order)
+        db.session.commit()
+
+        publish_message('user_interactions', {
+            "event": "PLAYLIST_UPDATE",
+            "user_id": g.user['user_id'],
+            "playlist_id": playlist_id,
+            "action": "batch",
+            "added": added,
+            "removed": removed,
+            "course_ids": order,
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        })
+
+        return jsonify({"message": "Playlist courses updated", "courses": order}), 200
+
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Playlist batch update error: {str(e)}")
+        return jsonify({"error": "Failed to update playlist courses"}), 500
+
 @app.route('/playlists/<int:playlist_id>', methods=['PUT'])
 @requires_role(['student'])
 def update_playlist(playlist_id):
@@ -269,13 +582,52 @@ def get_public_playlists():
             "id": p.id,
             "name": p.name,
             "owner": p.student_id,
-            "course_count": len(p.courses)
+            "course_count": p.course_count
         } for p in playlists]), 200
 
     except Exception as e:
         logger.error(f"Public playlists error: {str(e)}")
         return jsonify({"error": "Failed to retrieve playlists"}), 500
 
+MEMBERSHIP_PAGE_SIZE = 1000  # playlists per page
+
+@app.route('/playlists/memberships', methods=['GET'])
+def get_playlist_memberships():
+    """Course ids of every playlist, for other services to seed their copies.
+
+    GET /playlists/memberships?cursor=<last playlist id>. Pages are keyed by
+    playlist id; while more remain, the next cursor is sent in the
+    `X-Next-Cursor` header.
+    """
+    cursor = request.args.get('cursor', '0')
+    if not cursor.isdigit():
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    try:
+        playlist_ids = [playlist_id for (playlist_id,) in db.session.query(Playlist.id).filter(
+            Playlist.id > int(cursor)
+        ).order_by(Playlist.id).limit(MEMBERSHIP_PAGE_SIZE + 1)]
+        more = len(playlist_ids) > MEMBERSHIP_PAGE_SIZE
+        playlist_ids = playlist_ids[:MEMBERSHIP_PAGE_SIZE]
+
+        courses = defaultdict(list)
+        if playlist_ids:
+            for playlist_id, course_id in db.session.query(PlaylistCourse.playlist_id, PlaylistCourse.course_id).filter(
+                PlaylistCourse.playlist_id.between(playlist_ids[0], playlist_ids[-1])
+            ).order_by(PlaylistCourse.playlist_id, PlaylistCourse.position):
+                courses[playlist_id].append(course_id)
+
+        response = jsonify({"playlists": [
+            {"id": playlist_id, "course_ids": courses[playlist_id]} for playlist_id in playlist_ids
+        ]})
+        if more:
+            response.headers['X-Next-Cursor'] = str(playlist_ids[-1])
+        return response, 200
+
+    except Exception as e:
+        logger.error(f"Playlist memberships error: {str(e)}")
+        return jsonify({"error": "Failed to retrieve memberships"}), 500
+
 @app.route('/playlists/<int:playlist_id>', methods=['GET'])
 @requires_role(['student'])
 def get_playlist(playlist_id):
@@ -288,20 +640,201 @@ def get_playlist(playlist_id):
             if playlist.branch_id != g.user['branch_id']:
                 return jsonify({"error": "Unauthorized access"}), 403
 
+        # One join for every course title instead of a lookup per entry
+        courses = db.session.query(Course.id, Course.title).join(
+            PlaylistCourse, PlaylistCourse.course_id == Course.id
+        ).filter(PlaylistCourse.playlist_id == playlist_id).order_by(
+            PlaylistCourse.position, PlaylistCourse.id
+        ).all()
+
         return jsonify({
             "id": playlist.id,
             "name": playlist.name,
             "is_public": playlist.is_public,
-            "courses": [{
-                "id": pc.course_id,
-                "title": Course.query.get(pc.course_id).title
-            } for pc in playlist.courses]
+            "course_count": playlist.course_count,
+            "courses": [{"id": course_id, "title": title} for course_id, title in courses]
         }), 200
 
     except Exception as e:
         logger.error(f"Get playlist error: {str(e)}")
         return jsonify({"error": "Failed to retrieve playlist"}), 500
 
+# Playback manifests
+MANIFEST_PREFETCH_SEGMENTS = 3
+HLS_FETCH_TIMEOUT = 2  # seconds
+HLS_CACHE_TTL = 300  # seconds
+HLS_FAILURE_TTL = 30  # seconds a failed fetch is remembered
+HLS_CACHE_SIZE = 1024
+hls_fetch_pool = ThreadPoolExecutor(max_workers=8)
+
+# video_url -> (expires_at, first segment urls). VOD playlists do not change
+# once generated, so the TTL only bounds staleness after a re-upload.
+# Failures are cached briefly as well, so while the origin is down each
+# manifest does not wait through the fetch timeouts again.
+hls_segment_cache = OrderedDict()
+hls_segment_lock = threading.Lock()
+
+def cache_segments(video_url, segments, ttl):
+    with hls_segment_lock:
+        hls_segment_cache[video_url] = (time.time() + ttl, segments)
+        hls_segment_cache.move_to_end(video_url)
+        while len(hls_segment_cache) > HLS_CACHE_SIZE:
+            hls_segment_cache.popitem(last=False)
+
+def fetch_first_segments(video_url):
+    """Return absolute URLs of the first segments of an HLS playlist."""
+    with hls_segment_lock:
+        cached = hls_segment_cache.get(video_url)
+        if cached and time.time() < cached[0]:
+            hls_segment_cache.move_to_end(video_url)
+            return cached[1]
+
+    playlist_url = video_url
+    segments = []
+    try:
+        for _ in range(2):  # a master playlist points at one more level
+            response = requests.get(playlist_url, timeout=HLS_FETCH_TIMEOUT)
+            response.raise_for_status()
+            lines = [line.strip() for line in response.text.splitlines()]
+            uris = [line for line in lines if line and not line.startswith('#')]
+            if any(line.startswith('#EXT-X-STREAM-INF') for line in lines) and uris:
+                playlist_url = urljoin(playlist_url, uris[0])
+                continue
+            segments = [urljoin(playlist_url, uri) for uri in uris[:MANIFEST_PREFETCH_SEGMENTS]]
+            break
+    except Exception as e:
+        # Prefetch hints are best effort; playback still works without them
+        logger.warning(f"Failed to read HLS playlist {video_url}: {e}")
+        cache_segments(video_url, [], HLS_FAILURE_TTL)
+        return []
+
+    cache_segments(video_url, segments, HLS_CACHE_TTL)
+    return segments
+
+def load_playlist_items(playlist_id):
+    return db.session.query(Course.id, Course.title, Course.video_url).join(
+        PlaylistCourse, PlaylistCourse.course_id == Course.id
+    ).filter(PlaylistCourse.playlist_id == playlist_id).order_by(
+        PlaylistCourse.position, PlaylistCourse.id
+    ).all()
+
+def can_play_playlist(playlist, user):
+    if user['role'] == 'admin':
+        return True
+    if user['role'] == 'student' and playlist.student_id == user['user_id']:
+        return True
+    return playlist.is_public and playlist.branch_id == user['branch_id']
+
+@app.route('/playlists/<int:playlist_id>/manifest', methods=['GET'])
+@requires_role(['student', 'teacher', 'admin'])
+def get_playlist_manifest(playlist_id):
+    """Ordered video URLs for a playlist, each with a hint for what to
+    preload next: the following item's playlist URL and first segments."""
+    try:
+        playlist = Playlist.query.get_or_404(playlist_id)
+        if not can_play_playlist(playlist, g.user):
+            return jsonify({"error": "Unauthorized access"}), 403
+
+        items = load_playlist_items(playlist_id)
+        # Segment lists are fetched concurrently; cached ones return at once
+        segments = list(hls_fetch_pool.map(fetch_first_segments, [item.video_url for item in items]))
+
+        manifest = []
+        for index, item in enumerate(items):
+            prefetch = None
+            if index + 1 < len(items):
+                prefetch = {
+                    "course_id": items[index + 1].id,
+                    "video_url": items[index + 1].video_url,
+                    "segments": segments[index + 1]
+                }
+            manifest.append({
+                "position": index,
+                "course_id": item.id,
+                "title": item.title,
+                "video_url": item.video_url,
+                "first_segments": segments[index],
+                "prefetch": prefetch
+            })
+
+        return jsonify({"playlist_id": playlist.id, "name": playlist.name, "items": manifest}), 200
+
+    except Exception as e:
+        logger.error(f"Playlist manifest error: {str(e)}")
+        return jsonify({"error": "Failed to build manifest"}), 500
+
+WARM_MAX_DELAY = 24 * 3600  # seconds ahead a warm-up may be scheduled
+WARM_MAX_PENDING = 256
+
+# playlist_id -> the one pending warm-up timer for it. Timers live in
+# memory only, so a restart drops whatever was scheduled.
+pending_warms = {}
+pending_warms_lock = threading.Lock()
+
+def warm_playlist_segments(playlist_id):
+    """Request each item's playlist and first segments through the
+    gateway so they are cached at the origin before students press play."""
+    with pending_warms_lock:
+        # Runs on its Timer thread; a replacement scheduled since stays
+        if pending_warms.get(playlist_id) is threading.current_thread():
+            del pending_warms[playlist_id]
+    with app.app_context():
+        items = load_playlist_items(playlist_id)
+    urls = []
+    for item in items:
+        urls.append(item.video_url)
+        urls.extend(fetch_first_segments(item.video_url))
+
+    def warm(url):
+        try:
+            return requests.get(url, timeout=HLS_FETCH_TIMEOUT * 5).ok
+        except Exception:
+            return False
+
+    warmed = sum(hls_fetch_pool.map(warm, urls))
+    logger.info(f"Warmed {warmed}/{len(urls)} HLS resources for playlist {playlist_id}")
+    return warmed, len(urls)
+
+@app.route('/playlists/<int:playlist_id>/manifest/warm', methods=['POST'])
+@requires_role(['teacher', 'admin'])
+def warm_playlist_manifest(playlist_id):
+    """Warm the origin cache for a playlist now, or at `at` (ISO 8601, at
+    most WARM_MAX_DELAY ahead) before a scheduled class. A new request
+    replaces the playlist's pending warm-up."""
+    try:
+        playlist = Playlist.query.get_or_404(playlist_id)
+        if not can_play_playlist(playlist, g.user):
+            return jsonify({"error": "Unauthorized access"}), 403
+
+        data = request.get_json(silent=True) or {}
+        delay = 0
+        if data.get('at'):
+            try:
+                at = parse_timestamp(data['at'])
+            except (TypeError, ValueError):
+                return jsonify({"error": "Invalid 'at' timestamp"}), 400
+            if at.tzinfo is None:
+                at = at.replace(tzinfo=timezone.utc)
+            delay = max((at - datetime.now(timezone.utc)).total_seconds(), 0)
+            if delay > WARM_MAX_DELAY:
+                return jsonify({"error": f"'at' must be within {WARM_MAX_DELAY // 3600} hours"}), 400
+
+        timer = threading.Timer(delay, warm_playlist_segments, args=(playlist_id,))
+        timer.daemon = True
+        with pending_warms_lock:
+            previous = pending_warms.get(playlist_id)
+            if previous is None and len(pending_warms) >= WARM_MAX_PENDING:
+                return jsonify({"error": "Too many pending warm-ups"}), 429
+            if previous is not None:
+                previous.cancel()
+            pending_warms[playlist_id] = timer
+            timer.start()
+        return jsonify({"message": "Cache warm-up scheduled", "in_seconds": round(delay)}), 202
+
+    except Exception as e:
+        logger.error(f"Playlist warm-up error: {str(e)}")
+        return jsonify({"error": "Failed to schedule warm-up"}), 500
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({"error": "Resource not found"}), 404
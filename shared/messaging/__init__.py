@@ -0,0 +1,14 @@
+from .consumer import DedupeStore, IdempotentConsumer
+from .envelope import (
+    ENVELOPE_CONTENT_TYPE, SCHEMA_VERSION, decode_events, encode_envelopes, encode_event, event_count, is_envelope,
+)
+from .publisher import Publisher, PublishError
+from .timestamps import parse_timestamp
+
+__all__ = [
+    'DedupeStore', 'IdempotentConsumer',
+    'ENVELOPE_CONTENT_TYPE', 'SCHEMA_VERSION', 'decode_events', 'encode_envelopes', 'encode_event',
+    'event_count', 'is_envelope',
+    'Publisher', 'PublishError',
+    'parse_timestamp',
+]
@@ -0,0 +1,176 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, delete, func, literal_column, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.event import listen
+from sqlalchemy.orm import scoped_session
+
+from .envelope import decode_events
+
+LOOKUP_CHUNK = 500  # ids per IN (...) query, under SQLite's variable limit
+
+
+def _field(event, name):
+    # Malformed events are left for the consumer itself to reject
+    return event.get(name) if isinstance(event, dict) else None
+
+
+class DedupeStore:
+    """Ids of events this service has already processed.
+
+    Recent ids live in an in-memory LRU; every id is also written to a
+    small table, so redeliveries are still recognized after a restart.
+    The table keeps roughly the newest `max_rows` ids.
+    """
+
+    PRUNE_EVERY = 10000  # inserted ids between two prunes
+
+    def __init__(self, engine, table='processed_events', capacity=100000, max_rows=1000000):
+        self.engine = engine
+        self.capacity = capacity
+        self.max_rows = max_rows
+        self.table = Table(
+            table, MetaData(),
+            Column('event_id', String(64), primary_key=True),
+            Column('processed_at', Integer, nullable=False)
+        )
+        self.table.create(engine, checkfirst=True)
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+        self._since_prune = 0
+
+    def _remember(self, event_ids):
+        with self._lock:
+            for event_id in event_ids:
+                self._recent[event_id] = None
+                self._recent.move_to_end(event_id)
+            while len(self._recent) > self.capacity:
+                self._recent.popitem(last=False)
+
+    def seen(self, event_ids):
+        """The subset of `event_ids` already processed."""
+        with self._lock:
+            hits = {event_id for event_id in event_ids if event_id in self._recent}
+        missing = list(set(event_ids) - hits)
+        if missing:
+            with self.engine.connect() as conn:
+                for start in range(0, len(missing), LOOKUP_CHUNK):
+                    hits.update(conn.execute(select(self.table.c.event_id).where(
+                        self.table.c.event_id.in_(missing[start:start + LOOKUP_CHUNK])
+                    )).scalars())
+        self._remember(hits)
+        return hits
+
+    def add(self, event_ids, session=None):
+        """Record ids as processed.
+
+        Given a `session`, the ids are written inside its open transaction,
+        so they commit or roll back together with the work they stand for,
+        and enter the LRU once that transaction commits. Without one they
+        are committed on their own, after the caller's work.
+        """
+        event_ids = list(dict.fromkeys(event_ids))
+        if not event_ids:
+            return
+        with self._lock:
+            self._since_prune += len(event_ids)
+            prune = self._since_prune >= self.PRUNE_EVERY
+            if prune:
+                self._since_prune = 0
+        if session is not None:
+            self._insert(session, event_ids, prune)
+            self._pending(session).extend(event_ids)
+            return
+        with self.engine.begin() as conn:
+            self._insert(conn, event_ids, prune)
+        self._remember(event_ids)
+
+    def _pending(self, session):
+        """Ids written in `session`'s open transaction, not yet committed."""
+        if isinstance(session, scoped_session):
+            session = session()
+        if self not in session.info:
+            session.info[self] = []
+
+            def committed(session):
+                self._remember(session.info[self])
+                session.info[self] = []
+
+            def rolled_back(session):
+                session.info[self] = []
+
+            listen(session, 'after_commit', committed)
+            listen(session, 'after_rollback', rolled_back)
+        return session.info[self]
+
+    def _insert(self, conn, event_ids, prune):
+        now = int(time.time())
+        conn.execute(sqlite_insert(self.table).on_conflict_do_nothing(),
+                     [{'event_id': event_id, 'processed_at': now} for event_id in event_ids])
+        if prune:
+            # rowids follow insertion order, so this drops the oldest ids
+            rowid = literal_column('rowid')
+            cutoff = conn.execute(select(func.max(rowid)).select_from(self.table)).scalar() - self.max_rows
+            if cutoff > 0:
+                conn.execute(delete(self.table).where(rowid <= cutoff))
+
+
+class IdempotentConsumer:
+    """Skips events a consumer must not apply again.
+
+    Events published by `origin` itself are dropped, as are events whose
+    event_id is in the dedupe store or repeated within the same batch.
+    Events without an id (published before ids existed) always pass.
+    Consumers that apply a batch in one transaction record its ids with
+    `processed(events, session)` before committing, so the work and its
+    ids commit together. `handle` applies events one by one and records
+    ids after them, so a crash in between means one more redelivery,
+    never a lost event.
+    """
+
+    def __init__(self, origin, store=None):
+        self.origin = origin
+        self.store = store
+
+    def is_own(self, properties):
+        """Whether a whole message came from this service, before decoding it."""
+        return bool(self.origin) and properties is not None and properties.app_id == self.origin
+
+    def fresh(self, items, key=None):
+        """The items whose events still need applying, in order.
+
+        `key` extracts the event dict when items are wrapped, e.g. in
+        (raw body, event) pairs.
+        """
+        key = key or (lambda item: item)
+        if self.origin:
+            items = [item for item in items if _field(key(item), 'origin') != self.origin]
+        ids = [_field(key(item), 'event_id') for item in items]
+        done = self.store.seen([i for i in ids if i]) if self.store else set()
+        fresh = []
+        for item, event_id in zip(items, ids):
+            if event_id:
+                if event_id in done:
+                    continue
+                done.add(event_id)
+            fresh.append(item)
+        return fresh
+
+    def processed(self, events, session=None):
+        if self.store:
+            self.store.add([_field(event, 'event_id') for event in events if _field(event, 'event_id')], session)
+
+    def handle(self, body, properties, apply):
+        """Decode a message and apply each fresh event; returns how many were applied.
+
+        Raises ValueError for undecodable messages, and whatever `apply` raises.
+        """
+        if self.is_own(properties):
+            return 0
+        events = self.fresh(decode_events(body, properties))
+        for event in events:
+            apply(event)
+        self.processed(events)
+        return len(events)
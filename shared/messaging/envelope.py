@@ -0,0 +1,62 @@
+import json
+import zlib
+
+import msgpack
+
+# An envelope is one AMQP message carrying a msgpack array of events.
+# Anything else on the wire is a single JSON-encoded event.
+ENVELOPE_CONTENT_TYPE = 'application/vnd.group2.events+msgpack'
+SCHEMA_VERSION = 1
+ENVELOPE_MAX_EVENTS = 500
+COMPRESS_MIN_BYTES = 1024  # smaller bodies do not shrink enough to be worth it
+
+
+def encode_envelopes(events, compress=True, max_events=ENVELOPE_MAX_EVENTS):
+    """Pack events into [(body, content_encoding, headers)], one per envelope."""
+    envelopes = []
+    for start in range(0, len(events), max_events):
+        chunk = events[start:start + max_events]
+        body = msgpack.packb(chunk, use_bin_type=True)
+        encoding = None
+        if compress and len(body) >= COMPRESS_MIN_BYTES:
+            body, encoding = zlib.compress(body), 'deflate'
+        envelopes.append((body, encoding, {'schema_version': SCHEMA_VERSION, 'events': len(chunk)}))
+    return envelopes
+
+
+def encode_event(event):
+    """A single event in the plain format: one JSON object per message."""
+    return json.dumps(event).encode()
+
+
+def is_envelope(properties):
+    return properties is not None and properties.content_type == ENVELOPE_CONTENT_TYPE
+
+
+def event_count(properties):
+    """How many events a message carries, without decoding it."""
+    if is_envelope(properties):
+        return int((properties.headers or {}).get('events', 1))
+    return 1
+
+
+def decode_events(body, properties=None):
+    """The list of events in a message, enveloped or plain JSON.
+
+    Raises ValueError for bodies that cannot be decoded, including envelopes
+    of a newer schema version than this code understands.
+    """
+    if not is_envelope(properties):
+        return [json.loads(body)]
+    version = (properties.headers or {}).get('schema_version')
+    if version != SCHEMA_VERSION:
+        raise ValueError(f"Unsupported envelope schema version {version}")
+    try:
+        if properties.content_encoding == 'deflate':
+            body = zlib.decompress(body)
+        events = msgpack.unpackb(body, raw=False)
+    except (zlib.error, msgpack.UnpackException, ValueError) as e:
+        raise ValueError(f"Malformed envelope: {e}")
+    if not isinstance(events, list):
+        raise ValueError("Malformed envelope: expected an array of events")
+    return events
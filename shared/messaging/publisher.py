@@ -0,0 +1,186 @@
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+
+import pika
+
+from .envelope import ENVELOPE_CONTENT_TYPE, encode_envelopes
+
+logger = logging.getLogger(__name__)
+
+
+class PublishError(Exception):
+    """Raised when a message could not be handed to the broker."""
+
+
+class _Slot:
+    """One long-lived connection and channel, used by one thread at a time."""
+
+    def __init__(self):
+        self.connection = None
+        self.channel = None
+        self.declared = set()
+
+    @property
+    def is_open(self):
+        return self.connection is not None and self.connection.is_open
+
+    def close(self):
+        try:
+            if self.is_open:
+                self.connection.close()
+        except Exception:
+            pass
+        self.connection = self.channel = None
+        self.declared = set()
+
+
+class Publisher:
+    """Pooled, persistent RabbitMQ publisher shared by the services.
+
+    Connections are opened lazily and kept open; each publish borrows a
+    channel from the pool, so concurrent request threads never share one.
+    Targets are declared once per connection rather than on every message.
+    After a failed connect, further attempts are refused until a backoff
+    (doubling up to `max_backoff`) has passed, so callers fail fast while
+    the broker is down. A background thread services idle connections so
+    the broker does not drop them for missed heartbeats.
+
+    Targets are queue names on the default exchange, or fanout exchanges
+    registered with `declare_fanout`. Every event published gets a unique
+    event_id and, given an `origin`, the name of the publishing service, so
+    consumers can skip redeliveries and their own events.
+    """
+
+    def __init__(self, host='rabbitmq', origin=None, pool_size=4, confirm=False, max_backoff=30, keepalive_interval=20):
+        self.parameters = pika.ConnectionParameters(host=host)
+        self.origin = origin
+        self.confirm = confirm
+        self.max_backoff = max_backoff
+        self._fanouts = {}  # exchange -> queues bound to it
+        self._slots = [_Slot() for _ in range(pool_size)]
+        self._idle = queue.LifoQueue()
+        for slot in self._slots:
+            self._idle.put(slot)
+        self._backoff = 0
+        self._retry_at = 0
+        self._backoff_lock = threading.Lock()
+        self._properties = pika.BasicProperties(delivery_mode=2, content_type='application/json', app_id=origin)
+        threading.Thread(target=self._keepalive, args=(keepalive_interval,), daemon=True).start()
+
+    def declare_fanout(self, exchange, bound_queues=()):
+        """Publish `exchange` as a durable fanout exchange, binding `bound_queues`."""
+        self._fanouts[exchange] = tuple(bound_queues)
+        return self
+
+    def stamp(self, event):
+        """A copy of `event` carrying an event_id and this publisher's origin.
+
+        Stamp events before storing them for a later retry, so every retry
+        publishes the same id.
+        """
+        stamped = dict(event)
+        stamped.setdefault('event_id', uuid.uuid4().hex)
+        if self.origin:
+            stamped.setdefault('origin', self.origin)
+        return stamped
+
+    def publish(self, target, message, properties=None):
+        """Publish a JSON-serializable message; raises PublishError on failure."""
+        self.publish_many(target, [message], properties)
+
+    def publish_many(self, target, messages, properties=None):
+        properties = properties or self._properties
+        self._send(target, [(m if isinstance(m, bytes) else json.dumps(self.stamp(m)).encode(), properties) for m in messages])
+
+    def publish_batch(self, target, events, compress=True, persistent=True):
+        """Publish events packed into as few msgpack envelopes as possible."""
+        self._send(target, [
+            (body, pika.BasicProperties(
+                delivery_mode=2 if persistent else None,
+                content_type=ENVELOPE_CONTENT_TYPE,
+                content_encoding=encoding,
+                headers=headers,
+                app_id=self.origin
+            ))
+            for body, encoding, headers in encode_envelopes([self.stamp(e) for e in events], compress)
+        ])
+
+    def _send(self, target, messages):
+        slot = self._idle.get()
+        try:
+            for attempt in (1, 2):
+                try:
+                    self._publish(slot, target, messages)
+                    return
+                except PublishError:
+                    raise
+                except Exception as e:
+                    # A connection the broker dropped is only noticed on use;
+                    # reconnect and retry once
+                    slot.close()
+                    if attempt == 2:
+                        raise PublishError(f"Publishing to {target} failed: {e}") from e
+        finally:
+            self._idle.put(slot)
+
+    def _publish(self, slot, target, messages):
+        if not slot.is_open:
+            self._connect(slot)
+        if target not in slot.declared:
+            self._declare(slot.channel, target)
+            slot.declared.add(target)
+        exchange, routing_key = (target, '') if target in self._fanouts else ('', target)
+        for body, properties in messages:
+            slot.channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+
+    def _connect(self, slot):
+        with self._backoff_lock:
+            if time.monotonic() < self._retry_at:
+                raise PublishError("Broker unavailable, backing off")
+        try:
+            slot.connection = pika.BlockingConnection(self.parameters)
+            slot.channel = slot.connection.channel()
+            if self.confirm:
+                slot.channel.confirm_delivery()
+        except Exception as e:
+            slot.close()
+            with self._backoff_lock:
+                self._backoff = min(max(self._backoff * 2, 1), self.max_backoff)
+                self._retry_at = time.monotonic() + self._backoff
+            raise PublishError(f"Connecting to broker failed: {e!r}") from e
+        with self._backoff_lock:
+            self._backoff = 0
+
+    def _declare(self, channel, target):
+        if target in self._fanouts:
+            channel.exchange_declare(exchange=target, exchange_type='fanout', durable=True)
+            for bound in self._fanouts[target]:
+                channel.queue_declare(queue=bound, durable=True)
+                channel.queue_bind(queue=bound, exchange=target)
+        else:
+            channel.queue_declare(queue=target, durable=True)
+
+    def _keepalive(self, interval):
+        while True:
+            time.sleep(interval)
+            # Take every idle slot out before servicing any, so each one is
+            # visited once instead of the LIFO top being taken over and over
+            idle = []
+            while True:
+                try:
+                    idle.append(self._idle.get_nowait())
+                except queue.Empty:
+                    break
+            for slot in idle:
+                try:
+                    if slot.is_open:
+                        slot.connection.process_data_events(time_limit=0)
+                except Exception as e:
+                    logger.warning(f"Dropping broken publisher connection: {e}")
+                    slot.close()
+                finally:
+                    self._idle.put(slot)
@@ -0,0 +1,13 @@
+from datetime import datetime
+
+
+def parse_timestamp(value):
+    """datetime.fromisoformat that also takes a trailing 'Z' for UTC.
+
+    Python before 3.11 rejects the 'Z' that JavaScript's toISOString()
+    and most other clients produce. Raises TypeError or ValueError like
+    fromisoformat does.
+    """
+    if isinstance(value, str) and value.endswith(('Z', 'z')):
+        value = value[:-1] + '+00:00'
+    return datetime.fromisoformat(value)
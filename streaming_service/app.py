@@ -1,13 +1,21 @@
-from datetime import datetime
+from datetime import datetime, timezone
 from flask import Flask, jsonify, request, g
 from flask_sqlalchemy import SQLAlchemy
+from collections import OrderedDict
 import os
 import uuid
+import time
+import queue
 import logging
+import threading
 import subprocess
+import pika
 from auth_lib import requires_role
+from messaging import Publisher, PublishError
 from werkzeug.utils import secure_filename
 
+SERVICE_NAME = 'streaming_service'  # origin stamped on published events
+
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///streaming.db'
 app.config['UPLOAD_FOLDER'] = '/tmp/hls'
@@ -17,6 +25,23 @@ db = SQLAlchemy(app)
 # Environment configuration
 MIST_RTMP_URL = os.getenv('MIST_RTMP_URL', 'rtmp://nginx_rtmp/live')
 CLIENT_HLS_BASE = os.getenv('CLIENT_HLS_BASE', 'http://nginx_gateway/hls')
+RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
+publisher = Publisher(host=RABBITMQ_HOST, origin=SERVICE_NAME, pool_size=1)
+# Pack heartbeat batches into msgpack envelopes; set to 0 while consumers
+# that only understand one JSON event per message are still running
+EVENT_ENVELOPES = os.getenv('EVENT_ENVELOPES', '1') != '0'
+
+# Playback heartbeats for analytics: at most one per student and course
+# every HEARTBEAT_SAMPLE_SECONDS while playing, plus every state change
+HEARTBEAT_QUEUE = 'user_interactions'
+HEARTBEAT_SAMPLE_SECONDS = 15
+HEARTBEAT_BUFFER = 10000
+HEARTBEAT_TRACKED_VIEWERS = 50000
+HEARTBEAT_PUBLISH_BATCH = 500
+HEARTBEAT_PROPERTIES = pika.BasicProperties(content_type='application/json')  # transient
+heartbeat_buffer = queue.Queue(maxsize=HEARTBEAT_BUFFER)
+last_heartbeat = OrderedDict()  # (student_id, course_id) -> (monotonic time, state)
+last_heartbeat_lock = threading.Lock()
 
 class StreamingSession(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -158,6 +183,56 @@ def stop_stream(stream_id):
         app.logger.error(f"Stream stop failed: {str(e)}")
         return jsonify({"error": "Stream termination failed"}), 500
 
+def sample_heartbeat(student_id, course_id, state):
+    """Whether this progress update should be sent to analytics."""
+    key = (student_id, course_id)
+    now = time.monotonic()
+    with last_heartbeat_lock:
+        previous = last_heartbeat.get(key)
+        if previous and previous[1] == state and now - previous[0] < HEARTBEAT_SAMPLE_SECONDS:
+            return False
+        last_heartbeat[key] = (now, state)
+        last_heartbeat.move_to_end(key)
+        while len(last_heartbeat) > HEARTBEAT_TRACKED_VIEWERS:
+            last_heartbeat.popitem(last=False)
+    return True
+
+def emit_heartbeat(student_id, data):
+    state = data.get('state', 'playing')
+    if not sample_heartbeat(student_id, data['course_id'], state):
+        return
+    try:
+        # Telemetry: dropped rather than slowing playback when the broker lags
+        heartbeat_buffer.put_nowait({
+            "event": "PLAYBACK_HEARTBEAT",
+            "course_id": data['course_id'],
+            "student_id": student_id,
+            "position": data['position'],
+            "duration": data.get('duration'),
+            "state": state,
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        })
+    except queue.Full:
+        app.logger.warning("Heartbeat buffer full, dropping heartbeat")
+
+def publish_heartbeats():
+    # Drains the buffer off the request path, a batch per pooled channel
+    while True:
+        batch = [heartbeat_buffer.get()]
+        while len(batch) < HEARTBEAT_PUBLISH_BATCH:
+            try:
+                batch.append(heartbeat_buffer.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            if EVENT_ENVELOPES:
+                publisher.publish_batch(HEARTBEAT_QUEUE, batch, persistent=False)
+            else:
+                publisher.publish_many(HEARTBEAT_QUEUE, batch, properties=HEARTBEAT_PROPERTIES)
+        except PublishError as e:
+            app.logger.error(f"Heartbeat publisher error: {e}")
+            time.sleep(5)
+
 @app.route('/api/progress', methods=['POST'])
 @requires_role(['student'])
 def save_progress():
@@ -173,6 +248,8 @@ def save_progress():
             session.last_position = data['position']
             db.session.commit()
 
+        emit_heartbeat(g.user['user_id'], data)
+
         return jsonify({"message": "Progress saved"}), 200
 
     except Exception as e:
@@ -185,4 +262,5 @@ if __name__ == '__main__':
         db.create_all()
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     os.chmod(app.config['UPLOAD_FOLDER'], 0o777)  # Ensure writable
+    threading.Thread(target=publish_heartbeats, daemon=True).start()
     app.run(host='0.0.0.0', port=3010)
\ No newline at end of file
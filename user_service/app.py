@@ -3,14 +3,16 @@ from flask import Flask, jsonify, request, g
 from flask_sqlalchemy import SQLAlchemy
 import pika
 import threading
-import json
 import logging
 import time
 from auth_lib import requires_role, decode_token
+from messaging import DedupeStore, IdempotentConsumer, Publisher, PublishError
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+SERVICE_NAME = 'user_service'  # origin stamped on published events
+
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///user.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
@@ -38,21 +40,17 @@ class User(db.Model):
 
 with app.app_context():
     db.create_all()
+    consumer = IdempotentConsumer(SERVICE_NAME, DedupeStore(db.engine))
 
 # RabbitMQ Setup
+# user_events is a fanout exchange so each consuming service gets every event
+# on its own queue; the user_events queue stays bound for this service.
+publisher = Publisher(host='rabbitmq', origin=SERVICE_NAME).declare_fanout('user_events', ['user_events'])
+
 def publish_message(queue, message):
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
-        channel = connection.channel()
-        channel.queue_declare(queue=queue, durable=True)
-        channel.basic_publish(
-            exchange='',
-            routing_key=queue,
-            body=json.dumps(message),
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
-        connection.close()
-    except Exception as e:
+        publisher.publish(queue, message)
+    except PublishError as e:
         logger.error(f"Failed to publish message: {e}")
 
 # User Endpoints
@@ -186,47 +184,52 @@ def health_check():
     return jsonify(status="ok"), 200
 
 # Enhanced RabbitMQ Consumer
+def apply_user_event(event):
+    logger.info(f"Processing event: {event['event']}")
+
+    if event['event'] == 'USER_CREATED':
+        user = User.query.get(event['user_id'])
+        if not user:
+            user = User(
+                id=event['user_id'],
+                name=event.get('name', 'New User'),
+                email=event['email'],
+                role=event['role'],
+                branch_id=event.get('branch_id')
+            )
+            db.session.add(user)
+            db.session.commit()
+
+    elif event['event'] == 'USER_UPDATED':
+        user = User.query.get(event['user_id'])
+        if user:
+            user.name = event.get('name', user.name)
+            user.email = event.get('email', user.email)
+            user.role = event.get('role', user.role)
+            user.branch_id = event.get('branch_id', user.branch_id)
+            db.session.commit()
+
+    elif event['event'] == 'USER_DELETED':
+        user = User.query.get(event['user_id'])
+        if user:
+            db.session.delete(user)
+            db.session.commit()
+
 def consume_user_events():
     while True:
         try:
             connection = pika.BlockingConnection(pika.ConnectionParameters(host='rabbitmq'))
             channel = connection.channel()
+            channel.exchange_declare(exchange='user_events', exchange_type='fanout', durable=True)
             channel.queue_declare(queue='user_events', durable=True)
+            channel.queue_bind(queue='user_events', exchange='user_events')
 
             def callback(ch, method, properties, body):
                 try:
                     with app.app_context():
-                        event = json.loads(body)
-                        logger.info(f"Processing event: {event['event']}")
-
-                        if event['event'] == 'USER_CREATED':
-                            user = User.query.get(event['user_id'])
-                            if not user:
-                                user = User(
-                                    id=event['user_id'],
-                                    name=event.get('name', 'New User'),
-                                    email=event['email'],
-                                    role=event['role'],
-                                    branch_id=event.get('branch_id')
-                                )
-                                db.session.add(user)
-                                db.session.commit()
-
-                        elif event['event'] == 'USER_UPDATED':
-                            user = User.query.get(event['user_id'])
-                            if user:
-                                user.name = event.get('name', user.name)
-                                user.email = event.get('email', user.email)
-                                user.role = event.get('role', user.role)
-                                user.branch_id = event.get('branch_id', user.branch_id)
-                                db.session.commit()
-
-                        elif event['event'] == 'USER_DELETED':
-                            user = User.query.get(event['user_id'])
-                            if user:
-                                db.session.delete(user)
-                                db.session.commit()
-
+                        # One JSON event or an envelope of several; duplicates
+                        # and this service's own events are skipped
+                        consumer.handle(body, properties, apply_user_event)
                 except Exception as e:
                     logger.error(f"Event processing error: {e}")
                 finally: